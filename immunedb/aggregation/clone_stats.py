@@ -8,6 +8,7 @@ from immunedb.common.models import (Clone, CloneStats, Sequence,
 import immunedb.common.modification_log as mod_log
 from immunedb.common.mutations import CloneMutations
 import immunedb.util.concurrent as concurrent
+import immunedb.util.funcs as funcs
 from immunedb.util.log import logger
 
 
@@ -158,11 +159,28 @@ def run_clone_stats(session, args):
         ).delete(synchronize_session=False)
         session.commit()
 
-    tasks = concurrent.TaskQueue()
+    # The number of sequences in each clone is used to start the largest
+    # clones first
+    size_query = session.query(
+        Sequence.clone_id, func.count(Sequence.ai).label('num_seqs')
+    ).filter(
+        ~Sequence.clone_id.is_(None)
+    ).group_by(Sequence.clone_id)
+    if args.clone_ids is not None:
+        sizes = {}
+        for chunk in funcs.chunks(clones, 1000):
+            sizes.update(size_query.filter(Sequence.clone_id.in_(chunk)))
+    elif args.subject_ids is not None:
+        sizes = dict(size_query.filter(
+            Sequence.subject_id.in_(args.subject_ids)))
+    else:
+        sizes = dict(size_query)
+
+    tasks = concurrent.TaskQueue(status_file=args.status_file)
     logger.info('Creating task queue to generate stats for {} clones.'.format(
         len(clones)))
     for cid in clones:
-        tasks.add_task(cid)
+        tasks.add_task(cid, cost=sizes.get(cid, 0))
 
     for i in range(0, args.nproc):
         session = config.init_db(args.db_config)
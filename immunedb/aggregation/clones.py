@@ -1,11 +1,13 @@
-from collections import OrderedDict
+from collections import namedtuple, OrderedDict
+import itertools
 
-from sqlalchemy import desc
-from sqlalchemy.sql import text
+import numpy as np
+from sqlalchemy import and_, desc, distinct, func
+from sqlalchemy.sql import bindparam, exists, text
 
-import dnautils
-from immunedb.common.models import (CDR3_OFFSET, Clone, Sequence,
-                                    SequenceCollapse, Subject)
+from immunedb.common.models import (CDR3_OFFSET, Clone, CloneStats,
+                                    deserialize_gaps, SelectionPressure,
+                                    Sequence, SequenceCollapse, Subject)
 import immunedb.common.modification_log as mod_log
 import immunedb.common.config as config
 from immunedb.trees import cut_tree, get_seq_pks, LineageWorker
@@ -16,40 +18,82 @@ import immunedb.util.lookups as lookups
 from immunedb.util.log import logger
 
 
-def generate_consensus(session, clone_ids):
+BUCKET_FIELDS = ('subject_id', 'v_gene', 'j_gene', 'cdr3_num_nts',
+                 '_insertions', '_deletions')
+BucketSequence = namedtuple('BucketSequence', ('sample_id', 'ai', 'clone_id',
+                                               'cdr3_nt', 'cdr3_aa'))
+
+
+class PrefetchedBucket(object):
+    """A bucket along with the fields of its eligible sequences needed to
+    assign them to clones, so workers need not query for them."""
+    __slots__ = BUCKET_FIELDS + ('seqs',)
+
+    def __init__(self, key, seqs):
+        for field, value in zip(BUCKET_FIELDS, key):
+            setattr(self, field, value)
+        self.seqs = seqs
+
+
+def generate_consensus(session, clone_ids, chunk_size=1000):
     """Generates consensus CDR3s for clones.
 
     :param Session session: The database session
     :param list clone_ids: The list of clone IDs to assign to groups
+    :param int chunk_size: The number of clones to update per query
 
     """
 
     if len(clone_ids) == 0:
         return
-    for clone in funcs.periodic_commit(
-            session,
-            session.query(Clone).filter(Clone.id.in_(clone_ids)),
-            interval=1000):
+    for chunk in funcs.chunks(sorted(clone_ids), chunk_size):
         seqs = session.query(
-            Sequence
-        ).join(SequenceCollapse).filter(
-            Sequence.clone_id == clone.id,
+            Sequence.clone_id, Sequence.cdr3_nt, Sequence.cdr3_num_nts,
+            Sequence.germline, Sequence._insertions, Clone.cdr3_num_nts.label(
+                'clone_cdr3_num_nts')
+        ).join(SequenceCollapse).join(
+            Clone, Clone.id == Sequence.clone_id
+        ).filter(
+            Sequence.clone_id.in_(chunk),
             SequenceCollapse.copy_number_in_subject > 0
-        ).all()
-        clone.cdr3_nt = funcs.consensus([s.cdr3_nt for s in seqs])
-        clone.cdr3_aa = lookups.aas_from_nts(clone.cdr3_nt)
+        ).order_by(
+            Sequence.clone_id, Sequence.sample_id, Sequence.ai
+        )
 
-        clone.germline = generate_germline(session, seqs, clone)
+        updates = []
+        for clone_id, clone_seqs in itertools.groupby(
+                seqs, key=lambda s: s.clone_id):
+            clone_seqs = list(clone_seqs)
+            cdr3_nt = funcs.consensus([s.cdr3_nt for s in clone_seqs])
+            germline, functional = generate_germline(
+                clone_seqs[0], clone_seqs[0].clone_cdr3_num_nts)
+            updates.append({
+                'id': clone_id,
+                'cdr3_nt': cdr3_nt,
+                'cdr3_aa': lookups.aas_from_nts(cdr3_nt),
+                'germline': germline,
+                'functional': functional,
+            })
+        session.bulk_update_mappings(Clone, updates)
+        session.commit()
 
-    session.commit()
 
+def generate_germline(rep_seq, cdr3_num_nts):
+    """Generates the germline of a clone from its representative sequence
+    with the CDR3 replaced by gaps.
+
+    :param Sequence rep_seq: The representative sequence of the clone
+    :param int cdr3_num_nts: The length of the clone's CDR3
+
+    :returns: The germline and if it is functional
+    :rtype: tuple
 
-def generate_germline(session, seqs, clone):
-    rep_seq = seqs[0]
-    cdr3_start_pos = sum(rep_seq.regions[:5])
+    """
+    cdr3_start_pos = sum(funcs.get_regions(
+        deserialize_gaps(rep_seq._insertions)))
     germline = rep_seq.germline[:cdr3_start_pos]
-    germline += '-' * clone.cdr3_num_nts
-    clone.functional = (
+    germline += '-' * cdr3_num_nts
+    functional = (
         len(germline) % 3 == 0 and
         not lookups.has_stop(germline)
     )
@@ -57,50 +101,235 @@ def generate_germline(session, seqs, clone):
     j_region = rep_seq.germline[cdr3_start_pos + rep_seq.cdr3_num_nts:]
     germline += j_region
 
-    return germline
+    return germline, functional
+
+
+def push_clone_ids(session, subject_ids=None, chunk_size=100000):
+    """Assigns sequences collapsed to another sequence in their subject the
+    clone of that sequence.  The update is run over ranges of ``ai``, each
+    committed separately, so locks are only held briefly.
+
+    :param Session session: The database session
+    :param list subject_ids: The subjects to update or ``None`` for all
+    :param int chunk_size: The number of ``ai`` values to update at once
 
+    :returns: The IDs of clones which sequences already assigned a clone
+        were moved out of or into
+    :rtype: set
 
-def push_clone_ids(session):
-    session.connection(mapper=Sequence).execute(text('''
-        UPDATE
-            sequences AS s
+    """
+    moved = set()
+    bounds = session.query(func.min(Sequence.ai), func.max(Sequence.ai))
+    if subject_ids is not None:
+        bounds = bounds.filter(Sequence.subject_id.in_(subject_ids))
+    min_ai, max_ai = bounds.one()
+    if min_ai is None:
+        return moved
+    # Each chunk starts at the next ai in use so gaps in the ai values of
+    # the subjects are skipped
+    next_ai = session.query(func.min(Sequence.ai))
+    if subject_ids is not None:
+        next_ai = next_ai.filter(Sequence.subject_id.in_(subject_ids))
+
+    tables = '''
+        sequences AS s
         JOIN sequence_collapse AS c
             ON s.sample_id=c.sample_id AND s.ai=c.seq_ai
         JOIN sequences as s2
             ON c.collapse_to_subject_seq_ai=s2.ai
-        SET s.clone_id=s2.clone_id
-        WHERE s.seq_id!=s2.seq_id
-    '''))
+    '''
+    where = '''
+        WHERE s.seq_id!=s2.seq_id AND s.ai>=:start AND s.ai<:end
+    '''
+    params = {}
+    if subject_ids is not None:
+        where += ' AND s.subject_id IN :subject_ids'
+        params['subject_ids'] = list(subject_ids)
+    # Sequences which already have a different clone, which happens when a
+    # collapsed group spans clones after new samples are added
+    moved_stmt = text('''
+        SELECT DISTINCT s.clone_id, s2.clone_id FROM {} {} AND
+            s.clone_id IS NOT NULL AND NOT s.clone_id <=> s2.clone_id
+    '''.format(tables, where))
+    update_stmt = text('UPDATE {} SET s.clone_id=s2.clone_id {}'.format(
+        tables, where))
+    if subject_ids is not None:
+        moved_stmt = moved_stmt.bindparams(
+            bindparam('subject_ids', expanding=True))
+        update_stmt = update_stmt.bindparams(
+            bindparam('subject_ids', expanding=True))
+
+    logger.info('Pushing clone IDs to collapsed sequences')
+    start = min_ai
+    while start is not None:
+        conn = session.connection(mapper=Sequence)
+        for old_clone_id, new_clone_id in conn.execute(
+                moved_stmt, start=start, end=start + chunk_size, **params):
+            moved.update((old_clone_id, new_clone_id))
+        conn.execute(update_stmt, start=start, end=start + chunk_size,
+                     **params)
+        session.commit()
+        logger.info('Pushed clone IDs through ai {} of {} ({}%)'.format(
+            min(start + chunk_size - 1, max_ai), max_ai,
+            int(100 * (start + chunk_size - min_ai) /
+                (max_ai - min_ai + chunk_size))))
+        start = next_ai.filter(Sequence.ai >= start + chunk_size).scalar()
+    moved.discard(None)
+    return moved
 
 
-def similar_to_all(seq, rest, field, min_similarity):
-    """Determines if the string ``seq`` is at least ``min_similarity``
-    similar to the list of strings ``rest``.
+def delete_empty_clones(session, clone_ids):
+    """Deletes the clones which no longer have any sequences.
 
-    :param str seq: The string to compare
-    :param list rest: The list of strings to compare to
-    :param int min_similarity: Minimum fraction to be considered similar
+    :param Session session: The database session
+    :param list clone_ids: The IDs of the clones to check
 
-    :returns: If ``seq`` is similar to every sequence in ``rest``
-    :rtype: bool
+    :returns: The IDs of the deleted clones
+    :rtype: set
 
     """
-    for comp_seq in rest:
-        dist = dnautils.hamming(
-            getattr(comp_seq, 'cdr3_' + field).replace('X', '-'),
-            getattr(seq, 'cdr3_' + field).replace('X', '-')
-        )
-        sim_frac = 1 - dist / len(comp_seq.cdr3_aa)
-        if sim_frac < min_similarity:
-            return False
-    return True
+    empty = set()
+    for chunk in funcs.chunks(sorted(clone_ids), 1000):
+        empty.update(c.id for c in session.query(Clone.id).filter(
+            Clone.id.in_(chunk),
+            ~exists().where(Sequence.clone_id == Clone.id)
+        ))
+    for chunk in funcs.chunks(sorted(empty), 1000):
+        session.query(Clone).filter(
+            Clone.parent_id.in_(chunk)
+        ).update({Clone.parent_id: None}, synchronize_session=False)
+        session.query(Clone).filter(
+            Clone.id.in_(chunk)
+        ).delete(synchronize_session=False)
+    return empty
+
+
+def invalidate_clones(session, clone_ids):
+    """Removes the statistics, selection pressure and tree of clones whose
+    sequences have changed so they are recalculated the next time
+    ``immunedb_clone_stats``, ``immunedb_clone_pressure`` and
+    ``immunedb_clone_trees`` are run.
+
+    :param Session session: The database session
+    :param list clone_ids: The IDs of the changed clones
+
+    """
+    if len(clone_ids) == 0:
+        return
+    for chunk in funcs.chunks(sorted(clone_ids), 1000):
+        session.query(CloneStats).filter(
+            CloneStats.clone_id.in_(chunk)
+        ).delete(synchronize_session=False)
+        session.query(SelectionPressure).filter(
+            SelectionPressure.clone_id.in_(chunk)
+        ).delete(synchronize_session=False)
+        session.query(Clone).filter(
+            Clone.id.in_(chunk)
+        ).update({Clone.tree: None}, synchronize_session=False)
+
+
+def get_changed_clones(session, subject_ids):
+    """Gets the clones which have statistics but contain sequences from a
+    sample for which they do not, which happens when sequences in a new
+    sample are collapsed to a sequence already in a clone.
 
+    :param Session session: The database session
+    :param list subject_ids: The subjects to check
+
+    :returns: The IDs of the changed clones
+    :rtype: set
 
-def can_subclone(sub_seqs, parent_seqs, min_similarity):
-    for seq in sub_seqs:
-        if not similar_to_all(seq, parent_seqs, min_similarity):
-            return False
-    return True
+    """
+    return set(c.clone_id for c in session.query(
+        distinct(Sequence.clone_id).label('clone_id')
+    ).filter(
+        Sequence.subject_id.in_(subject_ids),
+        ~Sequence.clone_id.is_(None),
+        exists().where(CloneStats.clone_id == Sequence.clone_id),
+        ~exists().where(and_(
+            CloneStats.clone_id == Sequence.clone_id,
+            CloneStats.sample_id == Sequence.sample_id
+        ))
+    ))
+
+
+class SimilarityIndex(object):
+    """An index over the CDR3s of every sequence in a bucket which finds the
+    first clone whose members' CDR3s are all at least ``min_similarity``
+    similar to a sequence's.  The distances from a sequence to every member
+    of every clone are computed at once over the encoded CDR3s.
+
+    :param list seqs: The sequences in the bucket
+    :param str field: The CDR3 field to compare, either ``nt`` or ``aa``
+    :param float min_similarity: Minimum fraction to be considered similar
+
+    """
+    def __init__(self, seqs, field, min_similarity):
+        self.min_similarity = min_similarity
+        cdr3s = ''.join(getattr(s, 'cdr3_' + field).replace('X', '-')
+                        for s in seqs)
+        self.cdr3s = np.frombuffer(
+            cdr3s.encode('ascii'), dtype=np.uint8).reshape(len(seqs), -1)
+        # Like dnautils.hamming, positions with an N or gap in either
+        # sequence are never counted as mismatches
+        self.wildcards = (self.cdr3s == ord('N')) | (self.cdr3s == ord('-'))
+        self.aa_lens = np.array([len(s.cdr3_aa) for s in seqs],
+                                dtype=np.float64)
+
+        self.clone_ids = []
+        self._positions = {}
+        self.clone_of = np.full(len(seqs), -1, dtype=np.int64)
+        for i, seq in enumerate(seqs):
+            if seq.clone_id is not None:
+                self.assign(i, seq.clone_id)
+
+    def assign(self, i, clone_id):
+        """Adds the ``i``-th sequence to a clone, appending the clone to the
+        end of the search order if it is new."""
+        if clone_id not in self._positions:
+            self._positions[clone_id] = len(self.clone_ids)
+            self.clone_ids.append(clone_id)
+        self.clone_of[i] = self._positions[clone_id]
+
+    def _dissimilar_clones(self, cdr3, wildcards):
+        mismatches = (
+            (self.cdr3s != cdr3) & ~self.wildcards & ~wildcards
+        ).sum(axis=1)
+        dissimilar = (1 - mismatches / self.aa_lens) < self.min_similarity
+        ruled_out = np.zeros(len(self.clone_ids), dtype=bool)
+        ruled_out[self.clone_of[dissimilar & (self.clone_of >= 0)]] = True
+        return ruled_out
+
+    def dissimilar_clones(self, cdr3):
+        """Determines which clones have a member that is not similar to a
+        CDR3 of the same length as those in the index.
+
+        :param str cdr3: The CDR3 at the level of the index
+
+        :returns: A boolean for each clone in ``clone_ids``
+        :rtype: numpy.ndarray
+
+        """
+        cdr3 = np.frombuffer(cdr3.replace('X', '-').encode('ascii'),
+                             dtype=np.uint8)
+        return self._dissimilar_clones(
+            cdr3, (cdr3 == ord('N')) | (cdr3 == ord('-')))
+
+    def find_clone(self, i):
+        """Finds the first clone whose members are all similar to the
+        ``i``-th sequence.
+
+        :param int i: The index of the sequence
+
+        :returns: The ID of the clone or ``None`` if there is none
+        :rtype: int
+
+        """
+        candidates = np.flatnonzero(~self._dissimilar_clones(
+            self.cdr3s[i], self.wildcards[i]))
+        if len(candidates) == 0:
+            return None
+        return self.clone_ids[candidates[0]]
 
 
 class ClonalWorker(concurrent.Worker):
@@ -120,6 +349,7 @@ class ClonalWorker(concurrent.Worker):
         'min_mut_occurrence': 2,
         'min_mut_samples': 1,
         'min_seq_instances': 1,
+        'tree_engine': 'clearcut',
     }
 
     def __init__(self, session, **kwargs):
@@ -141,14 +371,71 @@ class ClonalWorker(concurrent.Worker):
             Sequence.cdr3_num_nts == bucket.cdr3_num_nts,
             Sequence._insertions == bucket._insertions,
             Sequence._deletions == bucket._deletions,
-
-            SequenceCollapse.copy_number_in_subject >= self.min_copy,
         )
         if sort:
             query = query.order_by(
                 desc(SequenceCollapse.copy_number_in_subject),
                 Sequence.ai
             )
+        return self.filter_seqs(query)
+
+    def prefetch_buckets(self, subject_id):
+        """Gets every bucket in a subject with sequences that have not been
+        assigned a clone using a single streamed query rather than one query
+        per bucket.
+
+        :param int subject_id: The ID of the subject
+
+        :returns: A generator of buckets with the sequences that would be
+            returned by ``get_bucket_seqs`` in the same order
+        :rtype: generator of PrefetchedBucket
+
+        """
+        bucket_cols = [getattr(Sequence, f) for f in BUCKET_FIELDS]
+        query = self.session.query(
+            *bucket_cols + [getattr(Sequence, f)
+                            for f in BucketSequence._fields]
+        ).join(SequenceCollapse).filter(
+            Sequence.subject_id == subject_id
+        ).order_by(
+            *bucket_cols + [desc(SequenceCollapse.copy_number_in_subject),
+                            Sequence.ai]
+        )
+        rows = self.filter_seqs(query).yield_per(10000)
+
+        num_fields = len(BUCKET_FIELDS)
+        for key, group in itertools.groupby(
+                rows, key=lambda r: tuple(r[:num_fields])):
+            seqs = [BucketSequence(*r[num_fields:]) for r in group]
+            if any(s.clone_id is None for s in seqs):
+                yield PrefetchedBucket(key, seqs)
+
+    def get_mixed_buckets(self, subject_id):
+        """Gets the buckets in a subject which have both sequences assigned
+        to a clone and eligible sequences which are not, using a single
+        grouped query.
+
+        :param int subject_id: The ID of the subject
+
+        :returns: The fields of each bucket, in ``BUCKET_FIELDS`` order
+        :rtype: list
+
+        """
+        bucket_cols = [getattr(Sequence, f) for f in BUCKET_FIELDS]
+        query = self.filter_seqs(self.session.query(
+            *bucket_cols
+        ).join(SequenceCollapse).filter(
+            Sequence.subject_id == subject_id
+        ))
+        return query.group_by(*bucket_cols).having(and_(
+            func.count(Sequence.clone_id) > 0,
+            func.count(Sequence.clone_id) < func.count(Sequence.ai)
+        )).all()
+
+    def filter_seqs(self, query):
+        query = query.filter(
+            SequenceCollapse.copy_number_in_subject >= self.min_copy
+        )
         if self.min_identity > 0:
             query = query.filter(
                 Sequence.v_match / Sequence.v_length >= self.min_identity
@@ -197,7 +484,7 @@ class LineageClonalWorker(ClonalWorker):
             ))
             lineage = LineageWorker(
                 self.session,
-                clearcut.get_newick,
+                clearcut.TREE_ENGINES[self.tree_engine],
                 self.min_mut_copies,
                 self.min_mut_samples,
                 exclude_stops=False,
@@ -232,32 +519,36 @@ class SimilarityClonalWorker(ClonalWorker):
     def run_bucket(self, bucket):
         clones = OrderedDict()
         consensus_needed = set([])
-        query = self.get_bucket_seqs(bucket, sort=True)
-
-        if query.count() > 0:
-            for seq in query:
+        if isinstance(bucket, PrefetchedBucket):
+            seqs = bucket.seqs
+        else:
+            seqs = self.get_bucket_seqs(bucket, sort=True).all()
+
+        if len(seqs) > 0:
+            existing = set(s.clone_id for s in seqs if s.clone_id is not None)
+            for seq in seqs:
                 if seq.clone_id not in clones:
                     clones[seq.clone_id] = []
                 clones[seq.clone_id].append(seq)
             if None in clones:
-                for seq_to_add in clones[None]:
-                    for clone_id, existing_seqs in clones.items():
-                        if clone_id is None:
-                            continue
-                        if similar_to_all(seq_to_add, existing_seqs,
-                                          self.level, self.min_similarity):
-                            existing_seqs.append(seq_to_add)
-                            break
-                    else:
-                        new_clone = Clone(subject_id=seq.subject_id,
-                                          v_gene=seq.v_gene,
-                                          j_gene=seq.j_gene,
-                                          cdr3_num_nts=seq.cdr3_num_nts,
-                                          _insertions=seq._insertions,
-                                          _deletions=seq._deletions)
+                index = SimilarityIndex(seqs, self.level, self.min_similarity)
+                for i, seq_to_add in enumerate(seqs):
+                    if seq_to_add.clone_id is not None:
+                        continue
+                    clone_id = index.find_clone(i)
+                    if clone_id is None:
+                        new_clone = Clone(subject_id=bucket.subject_id,
+                                          v_gene=bucket.v_gene,
+                                          j_gene=bucket.j_gene,
+                                          cdr3_num_nts=bucket.cdr3_num_nts,
+                                          _insertions=bucket._insertions,
+                                          _deletions=bucket._deletions)
                         self.session.add(new_clone)
                         self.session.flush()
-                        clones[new_clone.id] = [seq_to_add]
+                        clone_id = new_clone.id
+                        clones[clone_id] = []
+                    clones[clone_id].append(seq_to_add)
+                    index.assign(i, clone_id)
                 del clones[None]
 
             for clone_id, seqs in clones.items():
@@ -271,6 +562,9 @@ class SimilarityClonalWorker(ClonalWorker):
                 if len(to_update) > 0:
                     self.session.bulk_update_mappings(Sequence, to_update)
                     consensus_needed.add(clone_id)
+            # Clones which existed before this run and gained sequences
+            # need their statistics, selection pressure and tree updated
+            invalidate_clones(self.session, consensus_needed & existing)
         generate_consensus(self.session, consensus_needed)
 
 
@@ -290,19 +584,41 @@ class SubcloneWorker(concurrent.Worker):
         if len(clones) == 0:
             return
         # The clones with indels are the only ones which can be subclones
-        parent_clones = set([c for c in clones if len(c.insertions) == 0 and
-                             len(c.deletions) == 0])
-        potential_subclones = [c for c in clones if c not in parent_clones and
+        parent_clones = sorted([c for c in clones if len(c.insertions) == 0 and
+                                len(c.deletions) == 0], key=lambda c: c.id)
+        parent_ids = set(c.id for c in parent_clones)
+        potential_subclones = [c for c in clones if c.id not in parent_ids and
                                c.parent_id is None]
         self.info('Bucket {} has {} clones; parents={}, subs={}'.format(
             bucket, len(clones), len(parent_clones), len(potential_subclones)))
+        if len(parent_clones) == 0 or len(potential_subclones) == 0:
+            return
+
+        # Duplicate CDR3s within a clone do not affect similarity so each is
+        # only compared once
+        cdr3s = self.session.query(
+            Sequence.clone_id, Sequence.cdr3_aa
+        ).filter(
+            Sequence.clone_id.in_([c.id for c in clones])
+        ).distinct().order_by(Sequence.clone_id, Sequence.cdr3_aa).all()
+        index_seqs = [s for s in cdr3s if s.clone_id in parent_ids]
+        if len(index_seqs) == 0:
+            return
+        index = SimilarityIndex(index_seqs, 'aa', self.min_similarity)
+        sub_cdr3s = {}
+        for seq in cdr3s:
+            sub_cdr3s.setdefault(seq.clone_id, []).append(seq.cdr3_aa)
 
         for subclone in potential_subclones:
-            for parent in parent_clones:
-                if can_subclone(subclone.sequences, parent.sequences,
-                                self.min_similarity):
-                    subclone.parent = parent
+            ruled_out = np.zeros(len(index.clone_ids), dtype=bool)
+            for cdr3 in sub_cdr3s.get(subclone.id, []):
+                ruled_out |= index.dissimilar_clones(cdr3)
+                # Stop once no parent can be compatible
+                if ruled_out.all():
                     break
+            candidates = np.flatnonzero(~ruled_out)
+            if len(candidates) > 0:
+                subclone.parent_id = index.clone_ids[candidates[0]]
         self.session.commit()
 
     def cleanup(self):
@@ -327,8 +643,10 @@ def run_subclones(session, subject_ids, args):
 
     logger.info('Generated {} total subclone tasks'.format(tasks.num_tasks()))
     for i in range(0, min(tasks.num_tasks(), args.nproc)):
-        tasks.add_worker(SubcloneWorker(config.init_db(args.db_config),
-                                        args.similarity))
+        tasks.add_worker(SubcloneWorker(
+            config.init_db(args.db_config),
+            args.__dict__.get('min_similarity',
+                              ClonalWorker.defaults['min_similarity'])))
     tasks.start()
 
 
@@ -343,8 +661,22 @@ def run_clones(session, args):
         subject_ids = [s.id for s in session.query(Subject.id)]
     else:
         subject_ids = args.subject_ids
+    existing_clones = not args.regen and session.query(Clone.id).filter(
+        Clone.subject_id.in_(subject_ids)
+    ).first() is not None
+    if args.method == 'lineage' and existing_clones:
+        # Lineages are built from every sequence in a bucket, so they cannot
+        # be extended with new sequences
+        checker = LineageClonalWorker(session, **args.__dict__)
+        for subject_id in subject_ids:
+            for bucket in checker.get_mixed_buckets(subject_id):
+                if not args.gene or bucket.v_gene.startswith(args.gene):
+                    raise ValueError(
+                        'Lineage clones cannot be updated incrementally but '
+                        'subject {} has new sequences in a bucket with '
+                        'existing clones.  Use --regen to recreate its '
+                        'clones.'.format(subject_id))
     mod_log.make_mod('clones', session=session, commit=True, info=vars(args))
-
     if args.regen:
         logger.info('Deleting existing clones')
         session.query(Clone).filter(
@@ -352,14 +684,26 @@ def run_clones(session, args):
         ).delete(synchronize_session=False)
         session.commit()
 
-    tasks = concurrent.TaskQueue()
+    methods = {
+        'similarity': SimilarityClonalWorker,
+        'lineage': LineageClonalWorker,
+    }
+    prefetch = args.method == 'similarity' and args.prefetch
+    tasks = concurrent.TaskQueue(status_file=args.status_file)
     for subject_id in subject_ids:
         logger.info('Generating task queue for subject {}'.format(
             subject_id))
+        if prefetch:
+            prefetcher = methods[args.method](session, **args.__dict__)
+            for bucket in prefetcher.prefetch_buckets(subject_id):
+                if not args.gene or bucket.v_gene.startswith(args.gene):
+                    tasks.add_task(bucket, cost=len(bucket.seqs) ** 2)
+            continue
+
         buckets = session.query(
             Sequence.subject_id, Sequence.v_gene, Sequence.j_gene,
             Sequence.cdr3_num_nts, Sequence._insertions,
-            Sequence._deletions
+            Sequence._deletions, func.count(Sequence.ai).label('num_seqs')
         ).filter(
             Sequence.subject_id == subject_id,
             Sequence.clone_id.is_(None)
@@ -369,15 +713,12 @@ def run_clones(session, args):
             Sequence._deletions
         )
         for bucket in buckets:
+            # Sequences are compared pairwise within a bucket
             if not args.gene or bucket.v_gene.startswith(args.gene):
-                tasks.add_task(bucket)
+                tasks.add_task(bucket, cost=bucket.num_seqs ** 2)
 
     logger.info('Generated {} total tasks'.format(tasks.num_tasks()))
 
-    methods = {
-        'similarity': SimilarityClonalWorker,
-        'lineage': LineageClonalWorker,
-    }
     for i in range(0, min(tasks.num_tasks(), args.nproc)):
         worker = methods[args.method](
             config.init_db(args.db_config), **args.__dict__
@@ -390,5 +731,17 @@ def run_clones(session, args):
     else:
         logger.info('Skipping subclones')
 
-    push_clone_ids(session)
+    moved = push_clone_ids(session, subject_ids)
     session.commit()
+
+    if existing_clones:
+        removed = delete_empty_clones(session, moved)
+        if len(removed) > 0:
+            logger.info('Deleted {} clones left without sequences'.format(
+                len(removed)))
+        changed = (get_changed_clones(session, subject_ids) | moved) - removed
+        logger.info('Updating {} existing clones with new sequences'.format(
+            len(changed)))
+        generate_consensus(session, changed)
+        invalidate_clones(session, changed)
+        session.commit()
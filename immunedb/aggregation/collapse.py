@@ -1,4 +1,5 @@
-from sqlalchemy.sql import exists
+from sqlalchemy import func
+from sqlalchemy.sql import exists, text
 
 import dnautils
 import immunedb.common.config as config
@@ -96,6 +97,37 @@ class CollapseWorker(concurrent.Worker):
         self._session.close()
 
 
+def inherit_clone_ids(session, subject_id):
+    """Assigns sequences which became the representative of a collapsed
+    group the clone of a sequence collapsed to them, so existing clones are
+    retained when a subject is collapsed again after adding samples.  If the
+    group contains sequences from more than one clone, the lowest clone ID
+    is used.
+
+    :param Session session: The database session
+    :param int subject_id: The ID of the subject
+
+    """
+    session.connection(mapper=Sequence).execute(text('''
+        UPDATE
+            sequences AS s
+        JOIN (
+            SELECT
+                c.collapse_to_subject_seq_ai AS ai,
+                MIN(s2.clone_id) AS clone_id
+            FROM sequence_collapse AS c
+            JOIN sequences AS s2
+                ON s2.sample_id=c.sample_id AND s2.ai=c.seq_ai
+            WHERE s2.subject_id=:subject_id AND s2.clone_id IS NOT NULL
+            GROUP BY c.collapse_to_subject_seq_ai
+        ) AS inherited
+            ON inherited.ai=s.ai
+        SET s.clone_id=inherited.clone_id
+        WHERE s.subject_id=:subject_id AND s.clone_id IS NULL
+    '''), subject_id=subject_id)
+    session.commit()
+
+
 def run_collapse(session, args):
     mod_log.make_mod('collapse', session=session, commit=True,
                      info=vars(args))
@@ -121,20 +153,24 @@ def run_collapse(session, args):
                     SequenceCollapse.sample_id == sample.id
                 ).delete(synchronize_session=False)
                 sample.sample_stats = []
-            logger.info('Resetting clone info for subject {}'.format(subject))
-            session.query(Clone).filter(Clone.subject_id == subject).delete()
+            if not args.incremental:
+                logger.info('Resetting clone info for subject {}'.format(
+                    subject))
+                session.query(Clone).filter(
+                    Clone.subject_id == subject).delete()
             subject_ids.append(subject)
     session.commit()
 
     logger.info('Creating task queue to collapse {} subjects.'.format(
         len(subject_ids)))
 
-    tasks = concurrent.TaskQueue()
+    tasks = concurrent.TaskQueue(status_file=args.status_file)
 
     for subject_id in subject_ids:
         buckets = session.query(
             Sequence.subject_id, Sequence.v_gene, Sequence.j_gene,
-            Sequence.cdr3_num_nts, Sequence._insertions, Sequence._deletions
+            Sequence.cdr3_num_nts, Sequence._insertions, Sequence._deletions,
+            func.count(Sequence.ai).label('num_seqs')
         ).filter(
             Sequence.subject_id == subject_id
         ).group_by(
@@ -142,7 +178,8 @@ def run_collapse(session, args):
             Sequence.cdr3_num_nts, Sequence._insertions, Sequence._deletions
         )
         for bucket in buckets:
-            tasks.add_task(bucket)
+            # Sequences are compared pairwise within a bucket
+            tasks.add_task(bucket, cost=bucket.num_seqs ** 2)
 
     logger.info('Generated {} total tasks'.format(tasks.num_tasks()))
 
@@ -150,4 +187,10 @@ def run_collapse(session, args):
         tasks.add_worker(CollapseWorker(config.init_db(args.db_config)))
     tasks.start()
 
+    if args.incremental:
+        for subject_id in subject_ids:
+            logger.info('Retaining existing clones for subject {}'.format(
+                subject_id))
+            inherit_clone_ids(session, subject_id)
+
     session.close()
@@ -44,6 +44,10 @@ def init_db(database_config, drop_all=False, as_maker=False, create=True):
     :param bool as_maker: If ``True``, the returned object will be a session
         maker rather than an session
 
+    If the config sets ``local_infile`` to ``true``, the connection allows
+    ``LOAD DATA LOCAL INFILE`` so sequences can be inserted with the
+    ``infile`` method.
+
     :returns: A ``session`` or, if ``as_maker`` is set, a ``session_maker``
 
     """
@@ -55,8 +59,11 @@ def init_db(database_config, drop_all=False, as_maker=False, create=True):
     conn = 'mysql+pymysql://{}:{}@{}/{}'.format(
         database_config['username'], database_config['password'],
         database_config['host'], database_config['database'])
+    connect_args = {'cursorclass': SSCursor}
+    if database_config.get('local_infile'):
+        connect_args['local_infile'] = True
     engine = create_engine(conn, pool_recycle=3600,
-                           connect_args={'cursorclass': SSCursor})
+                           connect_args=connect_args)
 
     if drop_all:
         Base.metadata.drop_all(engine)
@@ -10,12 +10,13 @@ class AlignmentException(Exception):
     pass
 
 
-def get_noresult_from_vdj(session, vdj, sample, reason):
+def get_noresult_from_vdj(session, vdj, sample, reason,
+                          store_sequence=True):
     return NoResult(
         seq_id=vdj.seq_id,
         sample_id=sample.id,
-        sequence=vdj.orig_sequence,
-        quality=vdj.orig_quality,
+        sequence=vdj.orig_sequence if store_sequence else None,
+        quality=vdj.orig_quality if store_sequence else None,
         reason=reason
     )
 
@@ -79,23 +80,37 @@ def get_seq_from_alignment(session, alignment, sample, strip_alleles=True):
 
 
 def add_sequences(session, alignments, sample, strip_alleles=True,
-                  error_action='discard'):
+                  error_action='discard', method='orm'):
     seqs_and_noresults = funcs.flatten([
         get_seq_from_alignment(session, a, sample, strip_alleles)
         for a in alignments
     ])
     succeeded = [n for n in seqs_and_noresults if type(n) == Sequence]
     failed = [n for n in seqs_and_noresults if type(n) == NoResult]
-    funcs.bulk_add(session, succeeded)
+    funcs.bulk_add(session, succeeded, method=method)
     funcs.bulk_add(session, failed)
     session.flush()
 
 
-def add_noresults_for_vdj(session, vdj, sample, reason):
-    try:
-        session.add(get_noresult_from_vdj(session, vdj, sample, reason))
-    except ValueError:
-        logger.warning('Unable to add noresult')
+def add_noresults(session, noresults, sample, store_sequences=True):
+    """Bulk inserts noresults.
+
+    :param Session session: The database session
+    :param list noresults: A list of ``(vdj, reason)`` pairs
+    :param Sample sample: The sample to which the noresults belong
+    :param bool store_sequences: If ``False``, only the identifier and reason
+        are stored for each noresult.  Such noresults cannot be locally
+        aligned later.
+
+    """
+    records = []
+    for vdj, reason in noresults:
+        try:
+            records.append(get_noresult_from_vdj(session, vdj, sample,
+                                                 reason, store_sequences))
+        except ValueError:
+            logger.warning('Unable to add noresult')
+    funcs.bulk_add(session, records)
 
 
 def get_common_seq(seqs, cutoff=True, right=False):
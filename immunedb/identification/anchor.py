@@ -19,6 +19,48 @@ class AnchorAligner(object):
     def __init__(self, v_germlines, j_germlines):
         self.v_germlines = v_germlines
         self.j_germlines = j_germlines
+        # Common germlines keyed by tie set since there are far fewer
+        # distinct tie sets than sequences
+        self._common_v = {}
+        self._common_j = {}
+
+    def get_common_v(self, v_genes):
+        """Gets the common sequence of a set of V germlines and the positions
+        of gaps before the CDR3 within it.
+
+        :param set v_genes: The V genes
+
+        :returns: A tuple of the common sequence and gap positions
+        :rtype: tuple
+
+        """
+        key = frozenset(v_genes)
+        if key not in self._common_v:
+            germ = get_common_seq([self.v_germlines[v] for v in key],
+                                  cutoff=False)
+            self._common_v[key] = (germ, tuple(
+                i for i, c in enumerate(germ[:CDR3_OFFSET]) if c == '-'))
+        return self._common_v[key]
+
+    def get_common_j(self, j_genes):
+        key = frozenset(j_genes)
+        if key not in self._common_j:
+            self._common_j[key] = get_common_seq(
+                [self.j_germlines[j] for j in key], right=True)
+        return self._common_j[key]
+
+    def precompute_germlines(self, avg_len, avg_mut):
+        """Populates the V tie cache and the common germline of every single
+        gene's tie set so worker processes forked afterwards share them.
+
+        :param float avg_len: The average V length of the sample
+        :param float avg_mut: The average V mutation fraction of the sample
+
+        """
+        self.v_germlines.precompute_ties(avg_len, avg_mut)
+        for gene in self.v_germlines:
+            self.get_common_v(self.v_germlines.get_ties(
+                [gene], avg_len, avg_mut))
 
     def get_alignment(self, vdj_sequence, limit_vs=None, limit_js=None):
         alignment = VDJAlignment(vdj_sequence)
@@ -214,9 +256,7 @@ class AnchorAligner(object):
             alignment.j_gene = self.j_germlines.get_ties(
                 alignment.j_gene, avg_len, avg_mut)
         # Set the germline to the V gene up to the CDR3
-        germ = get_common_seq(
-            [self.v_germlines[v] for v in alignment.v_gene], cutoff=False
-        )
+        germ, gaps = self.get_common_v(alignment.v_gene)
         alignment.germline = germ[:CDR3_OFFSET]
         # If we need to pad the sequence, do so, otherwise trim the sequence to
         # the germline length
@@ -227,16 +267,13 @@ class AnchorAligner(object):
         alignment.j_anchor_pos += alignment.seq_offset
 
         # Add germline gaps to sequence before CDR3 and update anchor positions
-        for i, c in enumerate(alignment.germline):
-            if c == '-':
-                alignment.sequence.add_gap(i)
-                alignment.j_anchor_pos += 1
-                if i < alignment.seq_start:
-                    alignment.seq_offset += 1
-
-        j_germ = get_common_seq(
-            [self.j_germlines[j] for j in alignment.j_gene], right=True
-        )
+        for i in gaps:
+            alignment.sequence.add_gap(i)
+            alignment.j_anchor_pos += 1
+            if i < alignment.seq_start:
+                alignment.seq_offset += 1
+
+        j_germ = self.get_common_j(alignment.j_gene)
         # Calculate the length of the CDR3
         alignment.cdr3_num_nts = (
             alignment.j_anchor_pos + self.j_germlines.anchor_len -
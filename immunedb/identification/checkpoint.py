@@ -0,0 +1,125 @@
+import glob
+import gzip
+import json
+import os
+import pickle
+import re
+
+from immunedb.common.models import (NoResult, Sample, SampleMetadata,
+                                    SampleStats, Sequence, SequenceCollapse)
+from immunedb.util.log import logger
+
+
+class SampleCheckpoint(object):
+    """Records the progress of identifying one sample in a state directory so
+    that an interrupted run can be resumed.  The results of each completed
+    phase are stored alongside the state so they need not be recomputed.
+
+    :param str state_dir: The directory holding checkpoint state
+    :param str sample_name: The name of the sample
+
+    """
+    def __init__(self, state_dir, sample_name):
+        self.state_dir = state_dir
+        self.sample_name = sample_name
+        self._base = os.path.join(
+            state_dir, re.sub(r'[^\w.-]', '_', sample_name))
+        self.state = {'sample_name': sample_name, 'phases': [],
+                      'complete': False}
+        if os.path.isfile(self._state_path):
+            with open(self._state_path) as fh:
+                self.state = json.load(fh)
+
+    @classmethod
+    def find_all(cls, state_dir):
+        """Gets the checkpoints of every sample with state in ``state_dir``.
+
+        :param str state_dir: The directory holding checkpoint state
+
+        :returns: A dictionary of sample names to checkpoints
+        :rtype: dict
+
+        """
+        checkpoints = {}
+        for path in glob.glob(os.path.join(state_dir, '*.json')):
+            with open(path) as fh:
+                name = json.load(fh)['sample_name']
+            checkpoints[name] = cls(state_dir, name)
+        return checkpoints
+
+    @property
+    def _state_path(self):
+        return self._base + '.json'
+
+    def _phase_path(self, phase):
+        return '{}.{}.pickle.gz'.format(self._base, phase)
+
+    def _write_state(self):
+        os.makedirs(self.state_dir, exist_ok=True)
+        tmp_path = self._state_path + '.tmp'
+        with open(tmp_path, 'w') as fh:
+            json.dump(self.state, fh)
+        os.replace(tmp_path, self._state_path)
+
+    @property
+    def started(self):
+        return os.path.isfile(self._state_path)
+
+    @property
+    def complete(self):
+        return self.state['complete']
+
+    def start(self):
+        self._write_state()
+
+    def has(self, phase):
+        return phase in self.state['phases']
+
+    def save(self, phase, data):
+        tmp_path = self._phase_path(phase) + '.tmp'
+        with gzip.open(tmp_path, 'wb', compresslevel=1) as fh:
+            pickle.dump(data, fh, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self._phase_path(phase))
+        self.state['phases'].append(phase)
+        self._write_state()
+
+    def load(self, phase):
+        logger.info('Loading {} results for sample {} from checkpoint'.format(
+            phase, self.sample_name))
+        with gzip.open(self._phase_path(phase), 'rb') as fh:
+            return pickle.load(fh)
+
+    def mark_complete(self):
+        for phase in self.state['phases']:
+            os.remove(self._phase_path(phase))
+        self.state['phases'] = []
+        self.state['complete'] = True
+        self._write_state()
+
+    def rollback(self, session, study_name):
+        """Removes the sample and everything inserted for it by an
+        interrupted run, so it is created again from its current metadata.
+
+        :param Session session: The database session
+        :param str study_name: The name of the study the sample belongs to
+
+        """
+        sample = session.query(Sample).filter(
+            Sample.name == self.sample_name,
+            Sample.study.has(name=study_name)
+        ).first()
+        if sample is None:
+            return
+        logger.info('Rolling back partially identified sample {}'.format(
+            self.sample_name))
+        sample_id = sample.id
+        session.expunge(sample)
+        for model in (SequenceCollapse, Sequence, NoResult, SampleMetadata,
+                      SampleStats):
+            session.query(model).filter(
+                model.sample_id == sample_id
+            ).delete(synchronize_session=False)
+        session.query(Sample).filter(
+            Sample.id == sample_id
+        ).delete(synchronize_session=False)
+        session.commit()
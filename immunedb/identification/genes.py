@@ -1,7 +1,11 @@
 from collections import OrderedDict
 
 import dnautils
+import hashlib
+import os
+import pickle
 import re
+import tempfile
 
 from Bio import SeqIO
 from Bio.Seq import Seq
@@ -9,20 +13,47 @@ from Bio.Seq import Seq
 from immunedb.common.models import CDR3_OFFSET
 from immunedb.util.hyper import hypergeom
 from immunedb.identification import AlignmentException, get_common_seq
+from immunedb.util.log import logger
+
+# Increment when the parsed germline classes change so stale caches are
+# ignored
+GERMLINE_CACHE_VERSION = 2
 
 
 class GermlineException(Exception):
     pass
 
 
+def germline_cache_dir():
+    """Gets the directory in which parsed germlines are cached.  This is
+    ``~/.cache/immunedb`` unless the ``IMMUNEDB_GERMLINE_CACHE`` environment
+    variable is set.  Setting it to an empty string disables the cache.
+
+    :returns: The cache directory or ``None`` if caching is disabled
+    :rtype: str
+
+    """
+    path = os.environ.get('IMMUNEDB_GERMLINE_CACHE')
+    if path is None:
+        return os.path.join(os.path.expanduser('~'), '.cache', 'immunedb')
+    return path or None
+
+
 class GeneName(object):
+    __slots__ = ('name', 'base', 'prefix', 'family', 'allele')
+    # Parsed names are cached since the same genes are constructed for every
+    # sequence and again each time they are unpickled
+    _parsed = {}
+
     def __init__(self, name):
-        self.name = name
-        try:
-            parts = re.search(r'((([A-Z]+)(\d+)([^\*]+)?)(\*(\d+))?)',
-                              self.name).groups()
-        except AttributeError:
-            raise AlignmentException('Invalid gene name {}'.format(name))
+        parts = self._parsed.get(name)
+        if parts is None:
+            try:
+                parts = re.search(r'((([A-Z]+)(\d+)([^\*]+)?)(\*(\d+))?)',
+                                  name).groups()
+            except AttributeError:
+                raise AlignmentException('Invalid gene name {}'.format(name))
+            self._parsed[name] = parts
 
         self.name = parts[0]
         self.base = parts[1]
@@ -30,6 +61,9 @@ class GeneName(object):
         self.family = parts[3]
         self.allele = parts[6] if parts[6] else None
 
+    def __reduce__(self):
+        return GeneName, (self.name,)
+
     def __str__(self):
         return self.name
 
@@ -59,12 +93,72 @@ class GeneTies(dict):
 
         self.update(genes)
 
-        self.allele_lookup = {}
+        alleles = {}
         for name in self.keys():
-            self.allele_lookup[name] = set([])
-            for name2 in self.keys():
-                if name2.base == name.base:
-                    self.allele_lookup[name].add(name2)
+            alleles.setdefault(name.base, set([])).add(name)
+        self.allele_lookup = {
+            name: set(alleles[name.base]) for name in self.keys()
+        }
+
+    def _cache_path(self, path_to_germlines, kwargs):
+        cache_dir = germline_cache_dir()
+        if cache_dir is None:
+            return None
+        digest = hashlib.sha256()
+        with open(path_to_germlines, 'rb') as fh:
+            for block in iter(lambda: fh.read(1 << 20), b''):
+                digest.update(block)
+        digest.update(repr((
+            GERMLINE_CACHE_VERSION, type(self).__name__,
+            sorted(kwargs.items())
+        )).encode())
+        return os.path.join(cache_dir, '{}-{}.pickle'.format(
+            type(self).__name__.lower(), digest.hexdigest()))
+
+    def _load_cache(self, cache_path):
+        """Restores parsed germlines from ``cache_path`` if it exists.
+
+        :returns: If the germlines were restored
+        :rtype: bool
+
+        """
+        if cache_path is None or not os.path.isfile(cache_path):
+            return False
+        try:
+            with open(cache_path, 'rb') as fh:
+                genes, attrs = pickle.load(fh)
+        except Exception as e:
+            logger.warning('Ignoring unreadable germline cache {}: {}'.format(
+                cache_path, e))
+            return False
+        self.update(genes)
+        self.__dict__.update(attrs)
+        return True
+
+    def _save_cache(self, cache_path):
+        if cache_path is None:
+            return
+        tmp_path = None
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                    dir=os.path.dirname(cache_path), delete=False) as fh:
+                tmp_path = fh.name
+                pickle.dump((dict(self), self.__dict__), fh,
+                            pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, cache_path)
+            tmp_path = None
+        except Exception as e:
+            # The cache is only an optimization so failing to write it must
+            # never stop identification
+            logger.warning('Unable to write germline cache {}: {}'.format(
+                cache_path, e))
+        finally:
+            if tmp_path is not None:
+                try:
+                    os.unlink(tmp_path)
+                except OSError:
+                    pass
 
     def all_ties(self, length, mutation, cutoff=True):
         ties = {}
@@ -113,6 +207,18 @@ class GeneTies(dict):
 
         return self.ties[key][gene]
 
+    def precompute_ties(self, length, mutation):
+        """Populates the tie cache for every gene at the given length and
+        mutation so worker processes forked afterwards share it rather than
+        each building their own copy.
+
+        :param int length: The sequence length
+        :param float mutation: The mutation fraction
+
+        """
+        for gene in self:
+            self.get_single_tie(gene, length, mutation)
+
     def _hypergeom(self, length, mutation, K):
         key = (length, mutation, K)
         if key not in self.hypers:
@@ -135,6 +241,10 @@ class GeneTies(dict):
 
 class VGermlines(GeneTies):
     def __init__(self, path_to_germlines, **kwargs):
+        cache_path = self._cache_path(path_to_germlines, kwargs)
+        if self._load_cache(cache_path):
+            return
+
         self._min_length = None
         self.alignments = OrderedDict()
 
@@ -155,6 +265,7 @@ class VGermlines(GeneTies):
 
         super(VGermlines, self).__init__({k: v for k, v in self.items()},
                                          **kwargs)
+        self._save_cache(cache_path)
 
     def get_single_tie(self, gene, length, mutation):
         return super(VGermlines, self).get_single_tie(
@@ -283,6 +394,12 @@ class JGermlines(GeneTies):
                  anchor_len=defaults['anchor_len'],
                  min_anchor_len=defaults['min_anchor_len'],
                  **kwargs):
+        cache_path = self._cache_path(path_to_germlines, dict(
+            kwargs, upstream_of_cdr3=upstream_of_cdr3, anchor_len=anchor_len,
+            min_anchor_len=min_anchor_len))
+        if self._load_cache(cache_path):
+            return
+
         self._upstream_of_cdr3 = upstream_of_cdr3
         self._anchor_len = anchor_len
         self._min_anchor_len = min_anchor_len
@@ -301,6 +418,7 @@ class JGermlines(GeneTies):
                          self.items()}
         super(JGermlines, self).__init__({k: v for k, v in self.items()},
                                          **kwargs)
+        self._save_cache(cache_path)
 
     @property
     def upstream_of_cdr3(self):
@@ -1,9 +1,13 @@
+from collections import OrderedDict
+import hashlib
 import os
+import random
 import sys
 import time
 from sqlalchemy import func
 
-from Bio import SeqIO
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+from Bio.SeqIO.QualityIO import FastqGeneralIterator
 
 import dnautils
 
@@ -11,14 +15,19 @@ import immunedb.common.config as config
 import immunedb.common.modification_log as mod_log
 from immunedb.common.models import (Sample, SampleMetadata, Sequence, NoResult,
                                     Study, Subject)
-from immunedb.identification import (add_noresults_for_vdj, add_sequences,
+from immunedb.identification import (add_noresults, add_sequences,
                                      AlignmentException)
 from immunedb.identification.anchor import AnchorAligner
+from immunedb.identification.checkpoint import SampleCheckpoint
 from immunedb.identification.metadata import (MetadataException,
                                               parse_metadata, REQUIRED_FIELDS)
+from immunedb.identification.shards import (aggregate_shard, find_shards,
+                                            merge_shards, shard_path,
+                                            ShardException, write_shard)
 from immunedb.identification.vdj_sequence import VDJSequence
 from immunedb.identification.genes import JGermlines, VGermlines
 import immunedb.util.concurrent as concurrent
+from immunedb.util.files import input_path, open_input, sequence_format
 import immunedb.util.funcs as funcs
 from immunedb.util.log import logger
 
@@ -33,6 +42,9 @@ class IdentificationProps(object):
         'max_insertions': 5,
         'max_deletions': 5,
         'genotyping': False,
+        'insert_method': 'orm',
+        'discard_noresult_sequences': False,
+        'vties_sample': None,
     }
 
     def __init__(self, **kwargs):
@@ -249,98 +261,395 @@ def aggregate_collapse(aggregate_queue, db_config, sample_id, props):
             seqs_to_add.append(seq)
             if len(seqs_to_add) >= 1000:
                 add_sequences(session, seqs_to_add, sample,
-                              strip_alleles=not props.genotyping)
+                              strip_alleles=not props.genotyping,
+                              method=props.insert_method)
                 seqs_to_add = []
                 session.commit()
     if seqs_to_add:
         add_sequences(session, seqs_to_add, sample,
-                      strip_alleles=not props.genotyping)
+                      strip_alleles=not props.genotyping,
+                      method=props.insert_method)
     logger.info('Finished aggregating sequences')
     session.commit()
     session.close()
 
 
-def read_input(path):
-    vdjs = []
-    parser = SeqIO.parse(path, 'fasta' if path.endswith('.fasta') else 'fastq')
+def process_vdj_vties(vdj, aligner, avg_len, avg_mut, props):
+    result = process_vdj(vdj, aligner)
+    if result['status'] != 'success':
+        return result
+
+    alignment = result['alignment']
+    fused = {
+        # The sequence before V-tie expansion is only needed to find
+        # duplicates, so a digest is kept rather than a second full string
+        'seq_key': hashlib.blake2b(alignment.sequence.sequence.encode(),
+                                   digest_size=16).digest(),
+        'v_gene': set(alignment.v_gene),
+        'v_length': alignment.v_length,
+        'v_mutation_fraction': alignment.v_mutation_fraction,
+    }
+    fused.update(process_vties(alignment, aligner, avg_len, avg_mut, props))
+    return fused
 
-    # Collapse identical sequences
-    logger.info('Parsing input')
-    for record in parser:
+
+def aggregate_vdj_vties(aggregate_queue):
+    """Aggregates the results of ``process_vdj_vties``.  Reads which are
+    identical before V-tie expansion are collapsed into the first occurrence
+    before bucketing, so the result matches running ``aggregate_vdj`` and
+    ``aggregate_vties`` in two passes with the same averages.
+
+    """
+    uniques = OrderedDict()
+    noresults = []
+    for result in aggregate_queue:
+        if 'seq_key' not in result:
+            if result['status'] == 'noresult':
+                noresults.append(result)
+            elif result['status'] == 'error':
+                logger.error(
+                    'Unexpected error processing sequence {}\n\t{}'.format(
+                        result['vdj'].seq_id, result['reason']))
+        elif result['seq_key'] in uniques:
+            first = uniques[result['seq_key']]['alignment']
+            # Identical reads always align identically, so differing results
+            # can only come from a digest collision
+            if (first.sequence.sequence !=
+                    result['alignment'].sequence.sequence):
+                raise RuntimeError('Sequence digest collision for {}'.format(
+                    result['alignment'].sequence.seq_id))
+            first.sequence.copy_number += (
+                result['alignment'].sequence.copy_number)
+        else:
+            uniques[result['seq_key']] = result
+    uniques = list(uniques.values())
+    return {
+        'noresult': noresults,
+        'uniques': uniques,
+        'v_ties': aggregate_vties(uniques),
+    }
+
+
+def get_vties_averages(alignments):
+    avg_len = sum([a.v_length for a in alignments]) / len(alignments)
+    avg_mut = (
+        sum([a.v_mutation_fraction for a in alignments]) / len(alignments)
+    )
+    return avg_len, avg_mut
+
+
+def estimate_vties(vdjs, aligner, sample_size, nproc, seed=0):
+    """Estimates the average V length and mutation fraction used to find
+    V-ties from a random subsample of reads.
+
+    :param list vdjs: All reads in the sample
+    :param AnchorAligner aligner: The aligner for initial V/J assignment
+    :param int sample_size: The number of reads to sample
+    :param int nproc: The number of processes to use
+    :param int seed: The seed for sampling reads
+
+    :returns: The average V length and mutation fraction or ``None`` if no
+        sampled read could be aligned
+    :rtype: tuple
+
+    """
+    indices = sorted(random.Random(seed).sample(
+        range(len(vdjs)), min(sample_size, len(vdjs))))
+    alignments = concurrent.process_data(
+        [vdjs[i] for i in indices],
+        process_vdj,
+        aggregate_vdj,
+        nproc,
+        process_args={'aligner': aligner},
+    )['success']
+    if not alignments:
+        return None
+    return get_vties_averages(list(alignments))
+
+
+def compare_vties(v_germlines, uniques, estimated, exact):
+    """Counts the sequences whose V-ties would differ had the exact averages
+    been used instead of the estimated ones.
+
+    :param VGermlines v_germlines: The V germlines
+    :param list uniques: The results of ``process_vdj_vties`` for each unique
+        sequence
+    :param tuple estimated: The estimated average length and mutation
+    :param tuple exact: The exact average length and mutation
+
+    :returns: The number of sequences with differing V-ties
+    :rtype: int
+
+    """
+    differ = 0
+    for result in uniques:
+        if (v_germlines.get_ties(result['v_gene'], *estimated) !=
+                v_germlines.get_ties(result['v_gene'], *exact)):
+            differ += 1
+    return differ
+
+
+def read_records(path):
+    """Reads the ``(description, sequence, quality)`` of each record in a
+    FASTA or FASTQ file without building ``SeqRecord`` objects.  The quality
+    is the FASTQ quality string, or ``None`` for FASTA files.
+
+    """
+    with open_input(path) as fh:
+        if sequence_format(path, fh) == 'fasta':
+            for title, seq in SimpleFastaParser(fh):
+                yield title, seq, None
+        else:
+            yield from FastqGeneralIterator(fh)
+
+
+def read_vdjs(path, shard_index=None, num_shards=None):
+    """Reads the valid reads in a FASTA or FASTQ file along with the index of
+    each among the valid reads.  If ``num_shards`` is specified, only the
+    reads whose index is ``shard_index`` modulo ``num_shards`` are built and
+    the rest are only validated.
+
+    :returns: A generator of ``(read_index, vdj)`` pairs
+    :rtype: generator
+
+    """
+    read_index = -1
+    for description, sequence, quality in read_records(path):
+        if not VDJSequence.is_valid(sequence):
+            continue
+        read_index += 1
+        if num_shards is not None and read_index % num_shards != shard_index:
+            continue
         try:
-            vdjs.append(VDJSequence(
-                seq_id=record.description,
-                sequence=str(record.seq),
-                quality=funcs.ord_to_quality(
-                    record.letter_annotations.get('phred_quality')
-                )
-            ))
+            yield read_index, VDJSequence(
+                seq_id=description,
+                sequence=sequence,
+                quality=quality
+            )
         except ValueError:
             continue
 
+
+def read_input(path):
+    logger.info('Parsing input')
+    vdjs = [vdj for _, vdj in read_vdjs(path)]
     logger.info('There are {} sequences'.format(len(vdjs)))
     return vdjs
 
 
-def process_sample(db_config, v_germlines, j_germlines, path, meta, props,
-                   nproc):
-    session = config.init_db(db_config)
-    start = time.time()
-    logger.info('Starting sample {}'.format(meta['sample_name']))
-    sample = setup_sample(session, meta)
+def read_shard(path, shard_index, num_shards):
+    logger.info('Parsing input')
+    reads = list(read_vdjs(path, shard_index, num_shards))
+    logger.info('There are {} sequences in the shard'.format(len(reads)))
+    return reads
 
+
+def process_shard_vdj(read, aligner):
+    # The index of the read in the full input is kept with its result so
+    # shards can be merged in the original read order
+    read_index, vdj = read
+    result = process_vdj(vdj, aligner)
+    result['read_index'] = read_index
+    return result
+
+
+def process_shard(v_germlines, j_germlines, path, meta, nproc, shard_index,
+                  num_shards, shard_dir):
+    start = time.time()
+    logger.info('Starting shard {} of {} for sample {}'.format(
+        shard_index, num_shards, meta['sample_name']))
     aligner = AnchorAligner(v_germlines, j_germlines)
 
-    # Initial VJ assignment
-    alignments = concurrent.process_data(
-        read_input,
-        process_vdj,
-        aggregate_vdj,
+    # Initial VJ assignment for reads shard_index mod num_shards
+    shard = concurrent.process_data(
+        read_shard,
+        process_shard_vdj,
+        aggregate_shard,
         nproc,
         process_args={'aligner': aligner},
-        generate_args={'path': path},
+        generate_args={'path': path, 'shard_index': shard_index,
+                       'num_shards': num_shards}
     )
+    out_path = shard_path(shard_dir, meta['sample_name'], shard_index,
+                          num_shards)
+    write_shard(out_path, meta['sample_name'], shard_index, num_shards, shard)
+    logger.info('Wrote {} unique sequences and {} noresults to {} in '
+                '{}m'.format(len(shard['success']), len(shard['noresult']),
+                             out_path, round((time.time() - start) / 60., 1)))
+
+
+def realign_vties(session, sample, aligner, alignments, props, nproc,
+                  checkpoint=None):
+    # The results are popped so the caller does not keep the initial
+    # alignments alive once they have been realigned
     logger.info('Adding noresults')
-    for result in alignments['noresult']:
-        add_noresults_for_vdj(session, result['vdj'], sample, result['reason'])
-
-    alignments = alignments['success']
-    if alignments:
-        avg_len = (
-            sum([v.v_length for v in alignments]) /
-            len(alignments))
-        avg_mut = (
-            sum([v.v_mutation_fraction for v in alignments]) /
-            len(alignments)
-        )
-        sample.v_ties_mutations = avg_mut
-        sample.v_ties_len = avg_len
-        logger.info('Re-aligning {} sequences to V-ties: Mutations={}, '
-                    'Length={}'.format(len(alignments),
-                                       round(avg_mut, 2),
-                                       round(avg_len, 2)))
+    for chunk in funcs.chunks(alignments.pop('noresult'), 1000):
+        add_noresults(session, [(r['vdj'], r['reason']) for r in chunk],
+                      sample, not props.discard_noresult_sequences)
         session.commit()
-        # Realign to V-ties
-        v_ties = concurrent.process_data(
-            alignments,
-            process_vties,
-            aggregate_vties,
+
+    alignments = alignments.pop('success')
+    if not alignments:
+        return None
+
+    avg_len, avg_mut = get_vties_averages(alignments)
+    sample.v_ties_mutations = avg_mut
+    sample.v_ties_len = avg_len
+    logger.info('Re-aligning {} sequences to V-ties: Mutations={}, '
+                'Length={}'.format(len(alignments),
+                                   round(avg_mut, 2),
+                                   round(avg_len, 2)))
+    session.commit()
+    if checkpoint is not None and checkpoint.has('realigned'):
+        return checkpoint.load('realigned')
+
+    aligner.precompute_germlines(avg_len, avg_mut)
+    # Realign to V-ties
+    v_ties = concurrent.process_data(
+        alignments,
+        process_vties,
+        aggregate_vties,
+        nproc,
+        process_args={'aligner': aligner, 'avg_len': avg_len, 'avg_mut':
+                      avg_mut, 'props': props},
+    )
+    if checkpoint is not None:
+        v_ties['success'] = [list(b) for b in v_ties['success']]
+        checkpoint.save('realigned', v_ties)
+    return v_ties
+
+
+def identify_fused(session, sample, aligner, path, props, nproc,
+                   checkpoint=None):
+    if checkpoint is not None and checkpoint.has('aligned'):
+        # A previous attempt could not estimate the averages
+        return realign_vties(session, sample, aligner,
+                             checkpoint.load('aligned'), props, nproc,
+                             checkpoint)
+
+    if checkpoint is not None and checkpoint.has('fused'):
+        avg_len, avg_mut, fused = checkpoint.load('fused')
+    else:
+        vdjs = read_input(path)
+        estimate = estimate_vties(vdjs, aligner, props.vties_sample, nproc)
+        if estimate is None:
+            logger.warning('No sampled sequences could be aligned, aligning '
+                           'all sequences before finding V-ties')
+            alignments = concurrent.process_data(
+                vdjs,
+                process_vdj,
+                aggregate_vdj,
+                nproc,
+                process_args={'aligner': aligner},
+            )
+            if checkpoint is not None:
+                alignments['success'] = list(alignments['success'])
+                checkpoint.save('aligned', alignments)
+            return realign_vties(session, sample, aligner, alignments, props,
+                                 nproc, checkpoint)
+
+        avg_len, avg_mut = estimate
+        logger.info('Aligning {} sequences to V-ties with estimated averages '
+                    'from {} sequences: Mutations={}, Length={}'.format(
+                        len(vdjs), min(props.vties_sample, len(vdjs)),
+                        round(avg_mut, 2), round(avg_len, 2)))
+        aligner.precompute_germlines(avg_len, avg_mut)
+        fused = concurrent.process_data(
+            vdjs,
+            process_vdj_vties,
+            aggregate_vdj_vties,
             nproc,
             process_args={'aligner': aligner, 'avg_len': avg_len, 'avg_mut':
                           avg_mut, 'props': props},
         )
-        logger.info('Adding noresults')
+        if checkpoint is not None:
+            fused['v_ties']['success'] = [
+                list(b) for b in fused['v_ties']['success']]
+            checkpoint.save('fused', (avg_len, avg_mut, fused))
+
+    sample.v_ties_mutations = avg_mut
+    sample.v_ties_len = avg_len
+    session.commit()
 
-        for result in funcs.periodic_commit(session, v_ties['noresult'], 100):
-            add_noresults_for_vdj(session, result['alignment'].sequence,
-                                  sample, result['reason'])
+    logger.info('Adding noresults')
+    for chunk in funcs.chunks(fused['noresult'], 1000):
+        add_noresults(session, [(r['vdj'], r['reason']) for r in chunk],
+                      sample, not props.discard_noresult_sequences)
+        session.commit()
+
+    uniques = fused['uniques']
+    if not uniques:
+        return None
+
+    exact_len = sum([r['v_length'] for r in uniques]) / len(uniques)
+    exact_mut = (
+        sum([r['v_mutation_fraction'] for r in uniques]) / len(uniques)
+    )
+    differ = compare_vties(aligner.v_germlines, uniques, (avg_len, avg_mut),
+                           (exact_len, exact_mut))
+    logger.info('Exact averages are Mutations={}, Length={}.  V-ties of {}/{} '
+                '({}%) sequences differ from those with exact '
+                'averages'.format(round(exact_mut, 2), round(exact_len, 2),
+                                  differ, len(uniques),
+                                  round(100 * differ / len(uniques), 2)))
+    return fused['v_ties']
+
+
+def process_sample(db_config, v_germlines, j_germlines, path, meta, props,
+                   nproc, shards=None, checkpoint=None):
+    session = config.init_db(db_config)
+    start = time.time()
+    logger.info('Starting sample {}'.format(meta['sample_name']))
+    if checkpoint is not None:
+        if checkpoint.started:
+            checkpoint.rollback(session, meta['study_name'])
+        else:
+            checkpoint.start()
+    sample = setup_sample(session, meta)
+
+    aligner = AnchorAligner(v_germlines, j_germlines)
+
+    if shards is not None:
+        logger.info('Merging {} shards'.format(len(shards)))
+        alignments = merge_shards(shards, meta['sample_name'])
+        v_ties = realign_vties(session, sample, aligner, alignments,
+                               props, nproc, checkpoint)
+    elif props.vties_sample:
+        v_ties = identify_fused(session, sample, aligner, path, props, nproc,
+                                checkpoint)
+    else:
+        if checkpoint is not None and checkpoint.has('aligned'):
+            alignments = checkpoint.load('aligned')
+        else:
+            # Initial VJ assignment
+            alignments = concurrent.process_data(
+                read_input,
+                process_vdj,
+                aggregate_vdj,
+                nproc,
+                process_args={'aligner': aligner},
+                generate_args={'path': path},
+            )
+            if checkpoint is not None:
+                alignments['success'] = list(alignments['success'])
+                checkpoint.save('aligned', alignments)
+        v_ties = realign_vties(session, sample, aligner, alignments,
+                               props, nproc, checkpoint)
+
+    if v_ties is not None:
+        logger.info('Adding noresults')
+        for chunk in funcs.chunks(v_ties.pop('noresult'), 1000):
+            add_noresults(session, [(r['alignment'].sequence, r['reason'])
+                                    for r in chunk],
+                          sample, not props.discard_noresult_sequences)
+            session.commit()
 
         logger.info('Collapsing {} buckets'.format(len(v_ties['success'])))
         session.commit()
 
         # TODO: Change this so we arent copying everything between processes
         concurrent.process_data(
-            [list(v) for v in v_ties['success']],
+            [list(v) for v in v_ties.pop('success')],
             process_collapse,
             aggregate_collapse,
             nproc,
@@ -373,12 +682,16 @@ def process_sample(db_config, v_germlines, j_germlines, path, meta, props,
                 frac
             )
         )
+    if checkpoint is not None:
+        checkpoint.mark_complete()
     session.close()
 
 
 def run_identify(session, args):
-    mod_log.make_mod('identification', session=session, commit=True,
-                     info=vars(args))
+    sharding = args.shard_index is not None
+    if not sharding:
+        mod_log.make_mod('identification', session=session, commit=True,
+                         info=vars(args))
     # Load the germlines from files
     v_germlines = VGermlines(args.v_germlines, no_ties=args.genotyping)
     j_germlines = JGermlines(args.j_germlines, args.upstream_of_cdr3,
@@ -395,10 +708,17 @@ def run_identify(session, args):
         logger.error('Metadata file not found.')
         sys.exit(-1)
 
+    resuming = args.resume_dir is not None and not sharding
+    checkpoints = {}
+    if resuming:
+        checkpoints = SampleCheckpoint.find_all(args.resume_dir)
+
     with open(meta_fn, 'rU') as fh:
         try:
             metadata = parse_metadata(session, fh, args.warn_existing,
-                                      args.warn_missing, args.sample_dir)
+                                      args.warn_missing, args.sample_dir,
+                                      check_files=not args.merge_shards,
+                                      allow_existing=checkpoints)
         except MetadataException as ex:
             logger.error(ex)
             sys.exit(-1)
@@ -407,13 +727,34 @@ def run_identify(session, args):
     # Create the tasks for each file
     props = IdentificationProps(**args.__dict__)
     for sample_name in sorted(metadata.keys()):
+        path = input_path(args.sample_dir, metadata[sample_name]['file_name'])
+        if sharding:
+            process_shard(v_germlines, j_germlines, path,
+                          metadata[sample_name], args.nproc, args.shard_index,
+                          args.num_shards, args.shard_dir)
+            continue
+
+        shards = None
+        if args.merge_shards:
+            try:
+                shards = find_shards(args.shard_dir, sample_name)
+            except ShardException as e:
+                logger.error(e)
+                continue
+
+        checkpoint = None
+        if resuming:
+            checkpoint = checkpoints.get(sample_name) or SampleCheckpoint(
+                args.resume_dir, sample_name)
+            if checkpoint.complete:
+                logger.info('Skipping completed sample {}'.format(
+                    sample_name))
+                continue
         process_sample(
-            args.db_config, v_germlines, j_germlines,
-            os.path.join(
-                args.sample_dir,
-                metadata[sample_name]['file_name']
-            ),
+            args.db_config, v_germlines, j_germlines, path,
             metadata[sample_name],
             props,
-            args.nproc
+            args.nproc,
+            shards,
+            checkpoint
         )
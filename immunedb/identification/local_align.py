@@ -1,11 +1,11 @@
+from collections import OrderedDict
 import csv
 import os
 import re
 import subprocess
 import shlex
 import io
-
-from sqlalchemy import desc
+import time
 
 import dnautils
 
@@ -14,8 +14,10 @@ from immunedb.identification.vdj_sequence import VDJAlignment, VDJSequence
 from immunedb.identification.genes import (CDR3_OFFSET, GeneName, JGermlines,
                                            VGermlines)
 from immunedb.identification.identify import IdentificationProps
+from immunedb.identification.swalign import LocalAligner
 from immunedb.common.models import NoResult, Sample, Sequence, serialize_gaps
-from immunedb.util.funcs import format_ties, periodic_commit
+from immunedb.util.funcs import chunks, format_ties, periodic_commit
+import immunedb.util.concurrent as concurrent
 import immunedb.util.lookups as lookups
 from immunedb.util.log import logger
 
@@ -162,8 +164,7 @@ def get_formatted_ties(genes):
     return res
 
 
-def process_sample(session, sample, indexes, temp, v_germlines, j_germlines,
-                   nproc):
+def get_unaligned(session, sample):
     indels = session.query(
         Sequence.ai,
         Sequence.seq_id,
@@ -174,16 +175,30 @@ def process_sample(session, sample, indexes, temp, v_germlines, j_germlines,
         Sequence.probable_indel_or_misalign == 1
     ).order_by(Sequence.seq_id)
     # Get the sequences that were not identifiable
+    # Noresults stored without their sequence cannot be aligned
     noresults = session.query(NoResult).filter(
-        NoResult.sample_id == sample.id).order_by(NoResult.seq_id)
+        NoResult.sample_id == sample.id,
+        NoResult.sequence.isnot(None)
+    ).order_by(NoResult.seq_id)
 
     if indels.count() == 0 and noresults.count() == 0:
         logger.info('Sample {} has no indels or noresults'.format(
             sample.id))
-        return
+        return {}
     logger.info('Sample {} has {} indels and {} noresults'.format(
                 sample.id, indels.count(), noresults.count()))
 
+    sequences = OrderedDict()
+    for r in indels:
+        sequences['tp=Sequence|ai={}|sample_id={}|seq_id={}'.format(
+            r.ai, r.sample_id, r.seq_id)] = r.sequence
+    for r in noresults:
+        sequences['tp=NoResult|pk={}|sample_id={}|seq_id={}'.format(
+            r.pk, r.sample_id, r.seq_id)] = r.sequence
+    return sequences
+
+
+def get_sample_germlines(sample, v_germlines, j_germlines):
     mut_bucket = v_germlines.mut_bucket(sample.v_ties_mutations)
     len_bucket = v_germlines.length_bucket(sample.v_ties_len)
     bucket = '{}_{}'.format(str(mut_bucket).replace('.', ''),
@@ -192,26 +207,67 @@ def process_sample(session, sample, indexes, temp, v_germlines, j_germlines,
             sample.v_ties_len, sample.v_ties_mutations))
     sample_j_germlines = get_formatted_ties(j_germlines.all_ties(
         sample.v_ties_len, sample.v_ties_mutations))
+    return bucket, sample_v_germlines, sample_j_germlines
+
+
+def build_indexes(indexes, temp, bucket, sample_v_germlines,
+                  sample_j_germlines):
     if bucket not in indexes:
         indexes.add(bucket)
         v_path = os.path.join(temp, 'v_genes_{}'.format(bucket))
         j_path = os.path.join(temp, 'j_genes_{}'.format(bucket))
-        logger.info('Creating index for V-ties at {} length, {} '
-                    'mutation'.format(len_bucket, mut_bucket))
+        logger.info('Creating index for V-ties bucket {}'.format(bucket))
         build_index(sample_v_germlines, v_path)
         build_index(sample_j_germlines, j_path)
 
-    seq_path = os.path.join(temp, 'll_{}.fasta'.format(sample.id))
+
+def align_bowtie2(temp, index, sequences, nproc, file_name):
+    seq_path = os.path.join(temp, file_name)
     with open(seq_path, 'w+') as fh:
-        fh.write(get_fasta({'tp=Sequence|ai={}|sample_id={}|seq_id={}'.format(
-                r.ai, r.sample_id, r.seq_id): r.sequence for r in indels}))
-        fh.write(get_fasta({'tp=NoResult|pk={}|sample_id={}|seq_id={}'.format(
-            r.pk, r.sample_id, r.seq_id): r.sequence for r in noresults}))
+        fh.write(get_fasta(sequences))
+    return list(get_reader(align_reference(temp, index, seq_path, nproc)))
+
+
+def align_sequence(record, aligner):
+    return aligner.align(*record)
+
+
+def aggregate_alignments(alignments):
+    return list(alignments)
+
+
+def align_builtin(germlines, sequences, nproc):
+    if len(sequences) == 0:
+        return []
+    return concurrent.process_data(
+        list(sequences.items()),
+        align_sequence,
+        aggregate_alignments,
+        nproc,
+        process_args={'aligner': LocalAligner(germlines)}
+    )
+
+
+def process_sample(session, sample, indexes, temp, v_germlines, j_germlines,
+                   nproc, aligner='bowtie2'):
+    sequences = get_unaligned(session, sample)
+    if not sequences:
+        return []
+
+    bucket, sample_v_germlines, sample_j_germlines = get_sample_germlines(
+        sample, v_germlines, j_germlines)
+    if aligner == 'bowtie2':
+        build_indexes(indexes, temp, bucket, sample_v_germlines,
+                      sample_j_germlines)
 
     alignments = {}
-    logger.info('Running bowtie2 for V-gene sequences')
-    for line in get_reader(align_reference(temp, 'v_genes_{}'.format(bucket),
-                                           seq_path, nproc)):
+    logger.info('Running {} for V-gene sequences'.format(aligner))
+    if aligner == 'bowtie2':
+        v_lines = align_bowtie2(temp, 'v_genes_{}'.format(bucket), sequences,
+                                nproc, 'll_{}.fasta'.format(sample.id))
+    else:
+        v_lines = align_builtin(sample_v_germlines, sequences, nproc)
+    for line in v_lines:
         line['ref_offset'] = int(line['ref_offset']) - 1
         ref_gene = line['reference']
         try:
@@ -219,7 +275,7 @@ def process_sample(session, sample, indexes, temp, v_germlines, j_germlines,
                 ref_seq=sample_v_germlines[ref_gene].replace('-', ''),
                 min_size=CDR3_OFFSET, **line)
         except KeyError as e:
-            logger.warning('bowtie got invalid V: ' + str(e))
+            logger.warning('{} got invalid V: {}'.format(aligner, e))
             continue
         if len(rem_seqs) == 0:
             continue
@@ -237,16 +293,19 @@ def process_sample(session, sample, indexes, temp, v_germlines, j_germlines,
             'cdr3_start': len(ref)
         }
 
-    seq_path = os.path.join(temp, 'll_j_{}.fasta'.format(sample.id))
-    with open(seq_path, 'w+') as fh:
-        seqs = {k: v['v_rem_seq'] for k, v in alignments.items() if
-                len(v['v_rem_seq']) > 0}
-        fh.write(get_fasta(seqs))
+    seqs = OrderedDict(
+        (k, v['v_rem_seq']) for k, v in alignments.items() if
+        len(v['v_rem_seq']) > 0
+    )
+    logger.info('Running {} for J-gene sequences'.format(aligner))
+    if aligner == 'bowtie2':
+        j_lines = align_bowtie2(temp, 'j_genes_{}'.format(bucket), seqs,
+                                nproc, 'll_j_{}.fasta'.format(sample.id))
+    else:
+        j_lines = align_builtin(sample_j_germlines, seqs, nproc)
 
     tasks = []
-    logger.info('Running bowtie2 for J-gene sequences')
-    for line in get_reader(align_reference(temp, 'j_genes_{}'.format(bucket),
-                                           seq_path, nproc)):
+    for line in j_lines:
         line['ref_offset'] = int(line['ref_offset']) - 1
         ref_gene = line['reference']
         ref, seq, rem_seqs = create_seqs(
@@ -391,38 +450,144 @@ def add_sequences_from_sample(session, sample, sequences, props):
             continue
 
 
+def find_duplicates(seqs):
+    """Finds sequences which are duplicates of another, treating N and gaps
+    as wildcards, and merges their copy numbers into the sequence they
+    duplicate.  Each locally aligned sequence is merged into the matching
+    sequence with the highest copy number.
+
+    Sequences can only duplicate others with the same genes, CDR3 length,
+    and sequence length.  Within those buckets sequences without an N are
+    indexed by their gap positions and exact sequence.  Since sequences
+    aligned to the same germline almost always share gap positions, a
+    pairwise comparison is only needed for sequences with an N or those
+    with different gaps.
+
+    :param iterable seqs: The sequences with ``ai``, ``seq_id``,
+        ``v_gene``, ``j_gene``, ``cdr3_num_nts``, ``sequence``,
+        ``copy_number``, and ``locally_aligned`` attributes
+
+    :returns: A dictionary from ``ai`` to new copy number for the updated
+        sequences and a list of ``ai`` of the duplicates
+    :rtype: tuple
+
+    """
+    buckets = {}
+    locally_aligned = []
+    for seq in seqs:
+        entry = {
+            'ai': seq.ai,
+            'seq_id': seq.seq_id,
+            'sequence': seq.sequence,
+            'copy_number': seq.copy_number,
+            'gaps': tuple(m.start() for m in re.finditer('-', seq.sequence)),
+            'bucket': buckets.setdefault(
+                (seq.v_gene, seq.j_gene, seq.cdr3_num_nts,
+                 len(seq.sequence)),
+                {'exact': {}, 'wildcard': {}}
+            )
+        }
+        if 'N' in seq.sequence:
+            entry['bucket']['wildcard'][seq.ai] = entry
+        else:
+            entry['bucket']['exact'].setdefault(
+                entry['gaps'], {}).setdefault(
+                    seq.sequence, {})[seq.ai] = entry
+        if seq.locally_aligned:
+            locally_aligned.append(entry)
+
+    updated = {}
+    removed = []
+    for seq in sorted(locally_aligned, key=lambda e: e['ai']):
+        bucket = seq['bucket']
+        has_n = 'N' in seq['sequence']
+        candidates = list(bucket['wildcard'].values())
+        for gaps, exact in bucket['exact'].items():
+            if not has_n and gaps == seq['gaps']:
+                candidates.extend(exact.get(seq['sequence'], {}).values())
+            else:
+                candidates.extend(
+                    e for same in exact.values() for e in same.values())
+
+        matches = [
+            e for e in candidates if e['seq_id'] != seq['seq_id'] and
+            dnautils.equal(e['sequence'], seq['sequence'])
+        ]
+        if not matches:
+            continue
+
+        other_seq = min(matches, key=lambda e: (-e['copy_number'], e['ai']))
+        other_seq['copy_number'] += seq['copy_number']
+        updated[other_seq['ai']] = other_seq['copy_number']
+
+        if has_n:
+            del bucket['wildcard'][seq['ai']]
+        else:
+            del bucket['exact'][seq['gaps']][seq['sequence']][seq['ai']]
+        updated.pop(seq['ai'], None)
+        removed.append(seq['ai'])
+
+    return updated, removed
+
+
 def remove_duplicates(session, sample):
     logger.info('Removing duplicates from sample {}'.format(sample.id))
-    seqs = session.query(
-        Sequence
+    updated, removed = find_duplicates(session.query(
+        Sequence.ai, Sequence.seq_id, Sequence.v_gene, Sequence.j_gene,
+        Sequence.cdr3_num_nts, Sequence.sequence, Sequence.copy_number,
+        Sequence.locally_aligned
     ).filter(
-        Sequence.locally_aligned.is_(True),
         Sequence.sample_id == sample.id
-    ).order_by(Sequence.ai)
-
-    for seq in seqs:
-        potential_collapse = session.query(
-            Sequence
-        ).filter(
+    ))
+
+    logger.info('Collapsing {} duplicates into {} sequences'.format(
+        len(removed), len(updated)))
+    session.bulk_update_mappings(Sequence, [{
+        'sample_id': sample.id,
+        'ai': ai,
+        'copy_number': copy_number
+    } for ai, copy_number in updated.items()])
+    for chunk in chunks(removed, 1000):
+        session.query(Sequence).filter(
             Sequence.sample_id == sample.id,
-            Sequence.v_gene == seq.v_gene,
-            Sequence.j_gene == seq.j_gene,
-            Sequence.cdr3_num_nts == seq.cdr3_num_nts,
-        ).order_by(desc(Sequence.copy_number), Sequence.ai)
-
-        for other_seq in potential_collapse:
-            if (other_seq.seq_id == seq.seq_id or
-                    len(other_seq.sequence) != len(seq.sequence)):
-                continue
-
-            if dnautils.equal(other_seq.sequence, seq.sequence):
-                other_seq.copy_number += seq.copy_number
-                session.delete(seq)
-                break
+            Sequence.ai.in_(chunk)
+        ).delete(synchronize_session=False)
 
     session.commit()
 
 
+def compare_aligners(session, sample, indexes, temp, v_germlines,
+                     j_germlines, nproc):
+    """Locally aligns a sample's sequences with both bowtie2 and the builtin
+    aligner without modifying them and logs the time each took and how
+    many sequences were assigned the same V-gene, J-gene, and CDR3.
+
+    """
+    timings = {}
+    results = {}
+    for aligner in ('bowtie2', 'builtin'):
+        start = time.time()
+        results[aligner] = {
+            (s['r_type'], s['pk']): s['alignment'] for s in process_sample(
+                session, sample, indexes, temp, v_germlines, j_germlines,
+                nproc, aligner=aligner)
+        }
+        timings[aligner] = time.time() - start
+
+    bowtie2, builtin = results['bowtie2'], results['builtin']
+    both = set(bowtie2) & set(builtin)
+    same_v = [k for k in both if bowtie2[k].v_gene == builtin[k].v_gene]
+    same_j = [k for k in same_v if bowtie2[k].j_gene == builtin[k].j_gene]
+    same_cdr3 = [k for k in same_j if bowtie2[k].cdr3 == builtin[k].cdr3]
+    logger.info(
+        'Sample {}: bowtie2 aligned {} in {}s, builtin aligned {} in {}s; '
+        '{} aligned by both, {} with the same V, {} with the same V and J, '
+        '{} with the same V, J, and CDR3'.format(
+            sample.id, len(bowtie2), round(timings['bowtie2'], 2),
+            len(builtin), round(timings['builtin'], 2), len(both),
+            len(same_v), len(same_j), len(same_cdr3)))
+
+
 def run_fix_sequences(session, args):
     v_germlines = VGermlines(args.v_germlines)
     j_germlines = JGermlines(args.j_germlines, args.upstream_of_cdr3)
@@ -433,7 +598,12 @@ def run_fix_sequences(session, args):
     if args.sample_ids:
         samples = samples.filter(Sample.id.in_(args.sample_ids))
     for sample in samples:
+        if args.compare_aligners:
+            compare_aligners(session, sample, indexes, args.temp,
+                             v_germlines, j_germlines, args.nproc)
+            continue
         sequences = process_sample(session, sample, indexes, args.temp,
-                                   v_germlines, j_germlines, args.nproc)
+                                   v_germlines, j_germlines, args.nproc,
+                                   aligner=args.aligner)
         add_sequences_from_sample(session, sample, sequences, props)
         remove_duplicates(session, sample)
@@ -1,10 +1,10 @@
 import csv
-import os
 import re
 
 from sqlalchemy.sql import exists
 
 from immunedb.common.models import Sample, Sequence
+from immunedb.util.files import input_exists, input_path
 from immunedb.util.log import logger
 
 REQUIRED_FIELDS = ('file_name', 'study_name', 'sample_name', 'subject')
@@ -27,7 +27,8 @@ def check_populated(row):
                 ','.join(missing), row['sample_name']))
 
 
-def parse_metadata(session, fh, warn_existing, warn_missing, path):
+def parse_metadata(session, fh, warn_existing, warn_missing, path,
+                   check_files=True, allow_existing=()):
     reader = csv.DictReader(fh, delimiter='\t')
     provided_fields = set(reader.fieldnames)
     for field in provided_fields:
@@ -56,12 +57,16 @@ def parse_metadata(session, fh, warn_existing, warn_missing, path):
                 'Duplicate sample name {} in metadata.'.format(
                     row['sample_name']))
 
-        # Check if a sample with the same name is in the database
-        sample_in_db = session.query(Sample).filter(
-            Sample.name == row['sample_name'],
-            exists().where(
-                Sequence.sample_id == Sample.id
-            )).first()
+        # Check if a sample with the same name is in the database, unless it
+        # is being resumed from a checkpoint
+        if row['sample_name'] in allow_existing:
+            sample_in_db = None
+        else:
+            sample_in_db = session.query(Sample).filter(
+                Sample.name == row['sample_name'],
+                exists().where(
+                    Sequence.sample_id == Sample.id
+                )).first()
         if sample_in_db:
             message = 'Sample {} already exists. {}'.format(
                 row['sample_name'],
@@ -74,7 +79,8 @@ def parse_metadata(session, fh, warn_existing, warn_missing, path):
                 raise MetadataException(message)
 
         # Check if specified file exists
-        if not os.path.isfile(os.path.join(path, row['file_name'])):
+        if check_files and not input_exists(
+                input_path(path, row['file_name'])):
             message = (
                 'File {} for sample {} does not exist. {}'.format(
                     row['file_name'], row['sample_name'],
@@ -0,0 +1,148 @@
+import glob
+import gzip
+import os
+import pickle
+import re
+
+from immunedb.util.log import logger
+
+SHARD_VERSION = 1
+
+
+class ShardException(Exception):
+    pass
+
+
+def shard_path(shard_dir, sample_name, shard_index, num_shards):
+    return os.path.join(shard_dir, '{}.shard-{}-of-{}.pickle.gz'.format(
+        re.sub(r'[^\w.-]', '_', sample_name), shard_index, num_shards))
+
+
+def aggregate_shard(aggregate_queue):
+    """Aggregates the initial V/J assignments of one shard.  Like
+    ``aggregate_vdj``, identical sequences are collapsed into the first
+    occurrence, but the ``read_index`` of each result, its index in the full
+    input, is retained so shards can be merged in the original read order.
+
+    """
+    shard = {
+        'success': {},
+        'noresult': []
+    }
+    for result in aggregate_queue:
+        read_index = result.pop('read_index')
+        if result['status'] == 'success':
+            alignment = result['alignment']
+            seq_key = alignment.sequence.sequence
+            if seq_key in shard['success']:
+                shard['success'][seq_key][1].sequence.copy_number += (
+                    alignment.sequence.copy_number)
+            else:
+                shard['success'][seq_key] = (read_index, alignment)
+        elif result['status'] == 'noresult':
+            shard['noresult'].append((read_index, result))
+        elif result['status'] == 'error':
+            logger.error(
+                'Unexpected error processing sequence {}\n\t{}'.format(
+                    result['vdj'].seq_id, result['reason']))
+    shard['success'] = list(shard['success'].values())
+    return shard
+
+
+def write_shard(path, sample_name, shard_index, num_shards, shard):
+    """Writes the aggregated assignments of one shard to a compressed file.
+
+    :param str path: The path to write to
+    :param str sample_name: The name of the sample the shard belongs to
+    :param int shard_index: The index of the shard
+    :param int num_shards: The total number of shards
+    :param dict shard: The assignments as returned by ``aggregate_shard``
+
+    """
+    tmp_path = path + '.tmp'
+    with gzip.open(tmp_path, 'wb', compresslevel=1) as fh:
+        pickle.dump({
+            'version': SHARD_VERSION,
+            'sample_name': sample_name,
+            'shard_index': shard_index,
+            'num_shards': num_shards,
+            'success': shard['success'],
+            'noresult': shard['noresult'],
+        }, fh, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def find_shards(shard_dir, sample_name):
+    """Finds all shard files for a sample, verifying that the set is
+    complete.
+
+    :param str shard_dir: The directory containing the shard files
+    :param str sample_name: The name of the sample
+
+    :returns: The paths to the shards ordered by shard index
+    :rtype: list
+
+    """
+    paths = glob.glob(shard_path(shard_dir, sample_name, '*', '*'))
+    if not paths:
+        raise ShardException('No shards found for sample {}'.format(
+            sample_name))
+    found = {}
+    for path in paths:
+        index, total = re.search(r'\.shard-(\d+)-of-(\d+)\.pickle\.gz$',
+                                 path).groups()
+        found.setdefault(int(total), {})[int(index)] = path
+    if len(found) > 1:
+        raise ShardException(
+            'Shards for sample {} have different shard counts: {}'.format(
+                sample_name, ', '.join(str(t) for t in sorted(found))))
+    num_shards, shards = found.popitem()
+    missing = sorted(set(range(num_shards)) - set(shards))
+    if missing:
+        raise ShardException('Sample {} is missing shards {}'.format(
+            sample_name, ', '.join(str(m) for m in missing)))
+    return [shards[i] for i in range(num_shards)]
+
+
+def merge_shards(paths, sample_name):
+    """Merges the assignments from every shard of a sample.  The result is
+    identical to aggregating the initial assignments of all reads in a
+    single process.
+
+    :param list paths: The paths to the shards
+    :param str sample_name: The name of the sample
+
+    :returns: A dictionary with the ``success`` alignments and ``noresult``
+        results in the same form and order as ``aggregate_vdj``
+    :rtype: dict
+
+    """
+    success = {}
+    noresult = []
+    for path in paths:
+        with gzip.open(path, 'rb') as fh:
+            shard = pickle.load(fh)
+        if shard.get('version') != SHARD_VERSION:
+            raise ShardException('Shard {} has an unsupported version'.format(
+                path))
+        if shard['sample_name'] != sample_name:
+            raise ShardException('Shard {} is for sample {}, not {}'.format(
+                path, shard['sample_name'], sample_name))
+
+        for read_index, alignment in shard['success']:
+            seq_key = alignment.sequence.sequence
+            if seq_key not in success:
+                success[seq_key] = (read_index, alignment)
+                continue
+            first_index, first = success[seq_key]
+            if read_index < first_index:
+                first_index, first, alignment = read_index, alignment, first
+                success[seq_key] = (first_index, first)
+            first.sequence.copy_number += alignment.sequence.copy_number
+        noresult.extend(shard['noresult'])
+
+    return {
+        'success': [a for _, a in sorted(success.values(),
+                                         key=lambda s: s[0])],
+        'noresult': [r for _, r in sorted(noresult, key=lambda r: r[0])],
+    }
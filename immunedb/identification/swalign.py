@@ -0,0 +1,222 @@
+import math
+
+import numpy as np
+
+from Bio.Seq import Seq
+
+# Scoring mirrors the bowtie2 --local defaults used by local_align so the two
+# aligners accept and reject roughly the same reads.
+MATCH = 2
+MISMATCH = -6
+N_PENALTY = -1
+GAP_OPEN = 5
+GAP_EXTEND = 3
+
+_STOP, _DIAG, _DEL, _INS = range(4)
+_NEG_INF = -(2 ** 30)
+
+
+def encode(seq):
+    return np.frombuffer(seq.encode('ascii'), dtype=np.uint8)
+
+
+def min_score(read_len):
+    """Gets the minimum local alignment score for a read, equivalent to the
+    bowtie2 ``--score-min G,20,8`` default.
+
+    :param int read_len: The length of the read
+
+    :returns: The minimum score for an alignment to be reported
+    :rtype: float
+
+    """
+    return 20 + 8 * math.log(read_len)
+
+
+def compress_cigar(ops):
+    cigar = []
+    for op in ops:
+        if cigar and cigar[-1][1] == op:
+            cigar[-1][0] += 1
+        else:
+            cigar.append([1, op])
+    return ''.join('{}{}'.format(cnt, op) for cnt, op in cigar)
+
+
+class LocalAligner(object):
+    """An in-process affine-gap Smith-Waterman aligner which produces the
+    same fields ``local_align`` reads from bowtie2's SAM output.
+
+    Candidate references for each read are found with a k-mer index and the
+    dynamic programming matrices for all candidates are then filled together,
+    one read position at a time, with each row vectorized over every
+    candidate's reference positions.
+
+    :param dict references: A mapping of reference names to sequences
+    :param int kmer_len: The length of k-mers used to seed candidates
+    :param int max_candidates: The maximum number of references to fully
+        align each read against
+
+    """
+    def __init__(self, references, kmer_len=11, max_candidates=8):
+        self.kmer_len = kmer_len
+        self.max_candidates = max_candidates
+        self.names = sorted(references)
+        self.sequences = [references[n].replace('-', '').upper()
+                          for n in self.names]
+        self.width = max(len(s) for s in self.sequences)
+
+        # Pad references with a byte that never matches a read so all
+        # candidates can be stacked into a single matrix
+        self.encoded = np.zeros((len(self.names), self.width), dtype=np.uint8)
+        self.kmers = {}
+        for i, seq in enumerate(self.sequences):
+            self.encoded[i, :len(seq)] = encode(seq)
+            for pos in range(len(seq) - kmer_len + 1):
+                self.kmers.setdefault(seq[pos:pos + kmer_len], set()).add(i)
+
+    def candidates(self, read):
+        hits = {}
+        for pos in range(len(read) - self.kmer_len + 1):
+            for ref in self.kmers.get(read[pos:pos + self.kmer_len], ()):
+                hits[ref] = hits.get(ref, 0) + 1
+        ranked = sorted(hits.items(), key=lambda h: (-h[1], h[0]))
+        return [ref for ref, _ in ranked[:self.max_candidates]], (
+            ranked[0][1] if ranked else 0)
+
+    def _fill(self, read, refs):
+        refs = self.encoded[refs]
+        num_refs, width = refs.shape
+        read = encode(read)
+        ref_n = refs == ord('N')
+        ref_pad = refs == 0
+        pad = np.ones((num_refs, width + 1), dtype=bool)
+        pad[:, 1:] = ref_pad
+
+        shape = (len(read) + 1, num_refs, width + 1)
+        h_ptr = np.zeros(shape, dtype=np.uint8)
+        e_open = np.zeros(shape, dtype=bool)
+        f_open = np.zeros(shape, dtype=bool)
+
+        h_prev = np.zeros((num_refs, width + 1), dtype=np.int32)
+        f_prev = np.full((num_refs, width + 1), _NEG_INF, dtype=np.int32)
+        col_bonus = np.arange(width + 1, dtype=np.int32) * GAP_EXTEND
+
+        best_score, best_cell = 0, None
+        for i in range(1, len(read) + 1):
+            scores = np.where(refs == read[i - 1], MATCH, MISMATCH)
+            if read[i - 1] == ord('N'):
+                scores[:] = N_PENALTY
+            scores[ref_n] = N_PENALTY
+            scores[ref_pad] = _NEG_INF
+
+            diag = np.full((num_refs, width + 1), _NEG_INF, dtype=np.int32)
+            diag[:, 1:] = h_prev[:, :-1] + scores
+
+            f_from_h = h_prev - GAP_OPEN - GAP_EXTEND
+            f_from_f = f_prev - GAP_EXTEND
+            f_cur = np.maximum(f_from_h, f_from_f)
+            f_open[i] = f_from_h >= f_from_f
+
+            h_cur = np.maximum(np.maximum(diag, f_cur), 0)
+            # A horizontal gap never extends from a cell which was itself
+            # reached by a horizontal gap (opening is never cheaper than
+            # extending), so the row's gap scores are a running maximum of
+            # the scores without them.
+            running = np.maximum.accumulate(h_cur + col_bonus, axis=1)
+            e_cur = np.full((num_refs, width + 1), _NEG_INF, dtype=np.int32)
+            e_cur[:, 1:] = running[:, :-1] - GAP_OPEN - col_bonus[1:]
+            e_from_h = np.full((num_refs, width + 1), _NEG_INF,
+                               dtype=np.int32)
+            e_from_h[:, 1:] = h_cur[:, :-1] - GAP_OPEN - GAP_EXTEND
+            e_open[i] = e_from_h >= e_cur
+
+            h_final = np.maximum(h_cur, e_cur)
+            h_final[pad] = 0
+            ptr = np.full((num_refs, width + 1), _STOP, dtype=np.uint8)
+            ptr[(h_final == f_cur) & (h_final > 0)] = _INS
+            ptr[(h_final == e_cur) & (h_final > 0)] = _DEL
+            ptr[(h_final == diag) & (h_final > 0)] = _DIAG
+            h_ptr[i] = ptr
+
+            row_best = h_final.max()
+            if row_best > best_score:
+                ref, col = np.unravel_index(h_final.argmax(), h_final.shape)
+                best_score, best_cell = int(row_best), (i, ref, col)
+
+            h_prev = h_final
+            f_prev = f_cur
+
+        return best_score, best_cell, h_ptr, e_open, f_open
+
+    def _traceback(self, cell, h_ptr, e_open, f_open):
+        i, ref, j = cell
+        end_i, end_j = i, j
+        ops = []
+        state = _DIAG
+        while i > 0 and j > 0:
+            if state == _DIAG:
+                move = h_ptr[i, ref, j]
+                if move == _STOP:
+                    break
+                elif move == _DIAG:
+                    ops.append('M')
+                    i, j = i - 1, j - 1
+                else:
+                    state = move
+            elif state == _DEL:
+                ops.append('D')
+                if e_open[i, ref, j]:
+                    state = _DIAG
+                j -= 1
+            else:
+                ops.append('I')
+                if f_open[i, ref, j]:
+                    state = _DIAG
+                i -= 1
+        return i, j, end_i, end_j, ops[::-1]
+
+    def align(self, seq_id, read):
+        """Locally aligns a read to the best matching reference.
+
+        :param str seq_id: The identifier of the read
+        :param str read: The read sequence
+
+        :returns: A dictionary with the fields of a bowtie2 SAM record used
+            by ``local_align`` or ``None`` if the read could not be aligned
+        :rtype: dict
+
+        """
+        read = read.replace('-', '').upper()
+        strands = []
+        for rc, strand in ((False, read),
+                           (True, str(Seq(read).reverse_complement()))):
+            refs, hits = self.candidates(strand)
+            if refs:
+                strands.append((hits, rc, strand, refs))
+        if not strands:
+            return None
+
+        best = None
+        for _, rc, strand, refs in sorted(strands, key=lambda s: -s[0]):
+            score, cell, h_ptr, e_open, f_open = self._fill(strand, refs)
+            if cell is not None and (best is None or score > best[0]):
+                best = (score, rc, strand, refs, cell, h_ptr, e_open, f_open)
+
+        if best is None or best[0] < min_score(len(read)):
+            return None
+
+        score, rc, strand, refs, cell, h_ptr, e_open, f_open = best
+        start_i, start_j, end_i, end_j, ops = self._traceback(
+            cell, h_ptr, e_open, f_open)
+        ops = ['S'] * start_i + ops + ['S'] * (len(strand) - end_i)
+        return {
+            'seq_id': seq_id,
+            'flags': '16' if rc else '0',
+            'reference': self.names[refs[cell[1]]],
+            'ref_offset': str(start_j + 1),
+            'map_quality': '255',
+            'cigar': compress_cigar(ops),
+            'read_seq': strand,
+            'score': score,
+        }
@@ -7,12 +7,21 @@ from immunedb.common.models import CDR3_OFFSET
 import immunedb.util.lookups as lookups
 
 
+VALID_CHARACTERS = frozenset('ATCGN-')
+
+
 class VDJSequence(object):
+    # Instances are pickled between identification processes many times, so
+    # slots and a positional state keep them compact
+    __slots__ = ('seq_id', 'copy_number', 'orig_sequence', 'orig_quality',
+                 'rev_comp', '_sequence', '_quality',
+                 '_removed_prefix_sequence', '_removed_prefix_quality')
+
     def __init__(self, seq_id, sequence, quality=None, rev_comp=False,
                  copy_number=1):
         if quality and len(sequence) != len(quality):
             raise ValueError('Sequence and quality must be the same length')
-        if not all([c in 'ATCGN-' for c in sequence]):
+        if not VDJSequence.is_valid(sequence):
             raise ValueError('Invalid characters in sequence: {}'.format(
                 sequence))
 
@@ -26,6 +35,17 @@ class VDJSequence(object):
         self._removed_prefix_sequence = ''
         self._removed_prefix_quality = ''
 
+    @staticmethod
+    def is_valid(sequence):
+        return VALID_CHARACTERS.issuperset(sequence)
+
+    def __getstate__(self):
+        return tuple(getattr(self, s) for s in self.__slots__)
+
+    def __setstate__(self, state):
+        for slot, value in zip(self.__slots__, state):
+            setattr(self, slot, value)
+
     @property
     def sequence(self):
         return self._sequence
@@ -103,11 +123,18 @@ class VDJAlignment(object):
     INDEL_WINDOW = 30
     INDEL_MISMATCH_THRESHOLD = .6
 
+    __slots__ = ('sequence', 'germline', 'j_gene', 'v_gene',
+                 'locally_aligned', 'seq_offset', 'v_length', 'j_length',
+                 'v_mutation_fraction', 'cdr3_start', 'cdr3_num_nts',
+                 'germline_cdr3', 'post_cdr3_length', 'insertions',
+                 'deletions', 'j_anchor_pos')
+
     def __init__(self, sequence):
         self.sequence = sequence
         self.germline = None
         self.j_gene = set()
         self.v_gene = set()
+        self.j_anchor_pos = None
 
         self.locally_aligned = False
         self.seq_offset = 0
@@ -121,6 +148,13 @@ class VDJAlignment(object):
         self.insertions = set([])
         self.deletions = set([])
 
+    def __getstate__(self):
+        return tuple(getattr(self, s) for s in self.__slots__)
+
+    def __setstate__(self, state):
+        for slot, value in zip(self.__slots__, state):
+            setattr(self, slot, value)
+
     @property
     def filled_germline(self):
         return ''.join((
@@ -104,4 +104,5 @@ def import_template(session, in_file, regen):
         session.bulk_update_mappings(Sequence, to_update)
     session.commit()
     generate_consensus(session, db_clone_ids)
-    push_clone_ids(session)
+    push_clone_ids(session, set(
+        c['clone'].subject_id for c in seen_clones.values()))
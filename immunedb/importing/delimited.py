@@ -1,11 +1,16 @@
 import csv
 import dnautils
+import functools
+import heapq
+import itertools
+import multiprocessing as mp
 import os
+import queue
 import re
 
 from immunedb.common.models import (CDR3_OFFSET, Sample, SampleMetadata, Study,
                                     Subject)
-from immunedb.identification import (add_noresults_for_vdj, add_sequences,
+from immunedb.identification import (add_noresults, add_sequences,
                                      AlignmentException, get_common_seq)
 
 from immunedb.identification.metadata import (MetadataException,
@@ -114,9 +119,103 @@ def extract_adaptive_sequence(idx, line, v_germlines, j_germlines):
     }
 
 
-def read_file(session, fmt, handle, sample, v_germlines, j_germlines, props):
+# Unique alignments are indexed on this many blocks of their positions
+NUM_INDEX_BLOCKS = 16
+
+
+class UniqueAlignments(object):
+    """Collapses alignments with identical sequences, treating N and gaps as
+    wildcards.  Each unique alignment is merged into the first previously
+    seen alignment it matches.
+
+    Each length's unique sequences are split into ``NUM_INDEX_BLOCKS``
+    blocks of positions.  Sequences without a wildcard in a block are
+    indexed by its exact value and the rest are listed as having wildcards
+    there.  Any match of a new sequence must either have the same value in
+    a block where the new sequence has no wildcards or have wildcards in it,
+    so only those in the smallest such set of candidates are compared.
+
+    """
+    def __init__(self):
+        self._uniques = []
+        self._lengths = {}
+
+    def _get_index(self, length):
+        if length not in self._lengths:
+            size = max(1, -(-length // NUM_INDEX_BLOCKS))
+            blocks = [(start, start + size)
+                      for start in range(0, length, size)]
+            self._lengths[length] = {
+                'blocks': blocks,
+                'exact': [{} for _ in blocks],
+                'wildcard': [[] for _ in blocks],
+                'members': [],
+            }
+        return self._lengths[length]
+
+    def _candidates(self, index, seq, wildcard_blocks):
+        best = None
+        for i, (start, end) in enumerate(index['blocks']):
+            if wildcard_blocks[i]:
+                continue
+            exact = index['exact'][i].get(seq[start:end], [])
+            size = len(exact) + len(index['wildcard'][i])
+            if best is None or size < best[0]:
+                best = (size, exact, index['wildcard'][i])
+        if best is None:
+            return index['members']
+        # Both lists are in the order the uniques were added
+        return heapq.merge(best[1], best[2])
+
+    def add(self, alignment):
+        seq = alignment.sequence.sequence
+        index = self._get_index(len(seq))
+        wildcard_blocks = [
+            'N' in seq[start:end] or '-' in seq[start:end]
+            for start, end in index['blocks']
+        ]
+
+        for idx in self._candidates(index, seq, wildcard_blocks):
+            other = self._uniques[idx][1]
+            if dnautils.equal(other.sequence.sequence, seq):
+                other.sequence.copy_number += alignment.sequence.copy_number
+                return
+
+        idx = len(self._uniques)
+        self._uniques.append((len(seq), alignment))
+        index['members'].append(idx)
+        for i, (start, end) in enumerate(index['blocks']):
+            if wildcard_blocks[i]:
+                index['wildcard'][i].append(idx)
+            else:
+                index['exact'][i].setdefault(seq[start:end], []).append(idx)
+
+    def __iter__(self):
+        for _, alignment in sorted(self._uniques, key=lambda u: u[0]):
+            yield alignment
+
+
+def parse_file(fmt, handle, v_germlines, j_germlines, props):
+    """Parses and validates the sequences in a delimited file without
+    touching the database so that files can be parsed in worker processes.
+
+    :param str fmt: The format of the file, ``changeo`` or
+        ``adaptive``
+    :param file handle: The file handle to read from
+    :param VGermlines v_germlines: The V germlines
+    :param JGermlines j_germlines: The J germlines
+    :param IdentificationProps props: The properties used to validate
+        sequences
+
+    :returns: A dictionary with the valid unique ``sequences``, the
+        ``noresults`` as ``(vdj, reason)`` pairs and the ``v_ties_len`` and
+        ``v_ties_mutations`` averages of the valid sequences
+    :rtype: dict
+
+    """
     reader = csv.DictReader(handle, delimiter='\t')
-    uniques = {}
+    uniques = UniqueAlignments()
+    noresults = []
 
     for i, line in enumerate(reader):
         if fmt == 'adaptive':
@@ -125,45 +224,131 @@ def read_file(session, fmt, handle, sample, v_germlines, j_germlines, props):
                                                  j_germlines)
             except (AlignmentException, KeyError) as e:
                 seq = VDJSequence('seq_{}'.format(i), '')
-                add_noresults_for_vdj(session, seq, sample, str(e))
+                noresults.append((seq, str(e)))
                 continue
         seq = VDJSequence(line['SEQUENCE_ID'],
                           line['SEQUENCE_IMGT'].replace('.', '-'))
         if 'DUPCOUNT' in line:
             seq.copy_number = int(line['DUPCOUNT'])
         try:
-            alignment = create_alignment(seq, line, v_germlines, j_germlines)
-            for other in uniques.setdefault(
-                    len(alignment.sequence.sequence), []):
-                if dnautils.equal(other.sequence.sequence,
-                                  alignment.sequence.sequence):
-                    other.sequence.copy_number += (
-                        alignment.sequence.copy_number)
-                    break
-            else:
-                uniques[len(alignment.sequence.sequence)].append(alignment)
+            uniques.add(create_alignment(seq, line, v_germlines, j_germlines))
         except AlignmentException as e:
-            add_noresults_for_vdj(session, seq, sample, str(e))
+            noresults.append((seq, str(e)))
 
-    uniques = [s for k in sorted(uniques.keys()) for s in uniques[k]]
     lens = []
     muts = []
+    sequences = []
     for unique in uniques:
         try:
             props.validate(unique)
-            add_sequences(session, [unique], sample)
+            sequences.append(unique)
             lens.append(unique.v_length)
             muts.append(unique.v_mutation_fraction)
         except AlignmentException as e:
-            add_noresults_for_vdj(session, seq, sample, str(e))
+            noresults.append((unique.sequence, str(e)))
 
-    if len(lens) > 0:
-        sample.v_ties_len = sum(lens) / len(lens)
-        sample.v_ties_mutations = sum(muts) / len(muts)
+    return {
+        'sequences': sequences,
+        'noresults': noresults,
+        'v_ties_len': sum(lens) / len(lens) if lens else None,
+        'v_ties_mutations': sum(muts) / len(muts) if muts else None,
+    }
+
+
+def write_file(session, sample, parsed, props, chunk_size=1000):
+    for chunk in funcs.chunks(parsed['sequences'], chunk_size):
+        add_sequences(session, chunk, sample, method=props.insert_method)
+    for chunk in funcs.chunks(parsed['noresults'], chunk_size):
+        add_noresults(session, chunk, sample,
+                      not props.discard_noresult_sequences)
+
+    if parsed['v_ties_len'] is not None:
+        sample.v_ties_len = parsed['v_ties_len']
+        sample.v_ties_mutations = parsed['v_ties_mutations']
 
     session.commit()
 
 
+def read_file(session, fmt, handle, sample, v_germlines, j_germlines, props,
+              chunk_size=1000):
+    parsed = parse_file(fmt, handle, v_germlines, j_germlines, props)
+    write_file(session, sample, parsed, props, chunk_size)
+
+
+def parse_sample(task, fmt, v_germlines, j_germlines, props,
+                 chunk_size=1000):
+    """Parses one sample file and splits the result into parts small enough
+    to be sent between processes.
+
+    :param tuple task: The ``(sample_id, path)`` of the sample
+    :param str fmt: The format of the file, ``changeo`` or ``adaptive``
+    :param VGermlines v_germlines: The V germlines
+    :param JGermlines j_germlines: The J germlines
+    :param IdentificationProps props: The properties used to validate
+        sequences
+    :param int chunk_size: The number of sequences or noresults in each part
+
+    :returns: A generator of ``(sample_id, field, value)`` parts, where
+        ``field`` is ``sequences`` or ``noresults`` with a chunk of them as
+        the value, and finally ``v_ties`` with the V-tie averages
+    :rtype: generator
+
+    """
+    sample_id, path = task
+    with open(path) as fh:
+        parsed = parse_file(fmt, fh, v_germlines, j_germlines, props)
+    for field in ('sequences', 'noresults'):
+        for chunk in funcs.chunks(parsed.pop(field), chunk_size):
+            yield sample_id, field, chunk
+    yield sample_id, 'v_ties', (parsed['v_ties_len'],
+                                parsed['v_ties_mutations'])
+
+
+# Set in each import worker by _init_worker so the germlines are sent to a
+# worker once rather than with every sample
+_parser = None
+_parts = None
+
+
+def _init_worker(parser, parts):
+    global _parser, _parts
+    _parser = parser
+    _parts = parts
+
+
+def _parse_task(task):
+    for part in _parser(task):
+        _parts.put(part)
+
+
+def _parse_parallel(parser, tasks, nproc):
+    """Parses samples in a pool of worker processes, yielding the parts of
+    each as they are parsed."""
+    parts = mp.Queue(maxsize=4 * nproc)
+    pool = mp.Pool(processes=nproc, initializer=_init_worker,
+                   initargs=(parser, parts))
+    try:
+        pending = pool.map_async(_parse_task, tasks, chunksize=1)
+        remaining = len(tasks)
+        while remaining > 0:
+            try:
+                part = parts.get(timeout=1)
+            except queue.Empty:
+                if pending.ready():
+                    # Raises the exception of a failed worker
+                    pending.get()
+                continue
+            if part[1] == 'v_ties':
+                remaining -= 1
+            yield part
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
 def create_sample(session, metadata):
     study, new = funcs.get_or_create(
         session, Study, name=metadata['study_name'])
@@ -208,7 +393,7 @@ def run_import(session, args):
         logger.error('Metadata file not found.')
         return
 
-    with open(meta_fn, 'rU') as fh:
+    with open(meta_fn) as fh:
         try:
             metadata = parse_metadata(session, fh, args.warn_existing,
                                       args.warn_missing, args.sample_dir)
@@ -217,11 +402,47 @@ def run_import(session, args):
             return
 
     props = IdentificationProps(**args.__dict__)
+    tasks = []
     for sample_name in sorted(metadata.keys()):
         sample = create_sample(session, metadata[sample_name])
         if sample:
-            path = os.path.join(
-                args.sample_dir, metadata[sample_name]['file_name'])
-            with open(path) as fh:
-                read_file(session, args.format, fh, sample, v_germlines,
-                          j_germlines, props)
+            tasks.append((sample.id, os.path.join(
+                args.sample_dir, metadata[sample_name]['file_name'])))
+
+    # Files are parsed and validated in worker processes while this process
+    # serially writes the parts of each parsed sample to the database as
+    # they arrive.
+    parser = functools.partial(
+        parse_sample, fmt=args.format, v_germlines=v_germlines,
+        j_germlines=j_germlines, props=props)
+    nproc = min(args.nproc, len(tasks))
+    if nproc > 1:
+        logger.info('Parsing {} samples with {} processes'.format(
+            len(tasks), nproc))
+        parts = _parse_parallel(parser, tasks, nproc)
+    else:
+        parts = itertools.chain.from_iterable(map(parser, tasks))
+
+    counts = {}
+    imported = 0
+    for sample_id, field, value in parts:
+        sample = session.query(Sample).get(sample_id)
+        sample_counts = counts.setdefault(
+            sample_id, {'sequences': 0, 'noresults': 0})
+        if field == 'sequences':
+            add_sequences(session, value, sample, method=props.insert_method)
+            sample_counts[field] += len(value)
+        elif field == 'noresults':
+            add_noresults(session, value, sample,
+                          not props.discard_noresult_sequences)
+            sample_counts[field] += len(value)
+        else:
+            if value[0] is not None:
+                sample.v_ties_len, sample.v_ties_mutations = value
+            session.commit()
+            imported += 1
+            logger.info(
+                'Imported sample "{}" with {} sequences and {} noresults '
+                '({}/{})'.format(sample.name, sample_counts['sequences'],
+                                 sample_counts['noresults'], imported,
+                                 len(tasks)))
@@ -1,3 +1,4 @@
+from collections import OrderedDict
 import json
 
 import ete3
@@ -21,11 +22,11 @@ class LineageWorker(concurrent.Worker):
         self.post_tree_hook = post_tree_hook
 
     def get_tree(self, germline, sequences):
-        fasta, removed_muts = get_fasta_input(
+        seqs, removed_muts = get_tree_input(
             germline, sequences,
             self.min_mut_copies, self.min_mut_samples
         )
-        newick = self.newick_generator(fasta)
+        newick = self.newick_generator(seqs)
         if not newick:
             return None
         tree = add_tree_metadata(self.session, newick, germline, removed_muts)
@@ -81,8 +82,16 @@ class LineageWorker(concurrent.Worker):
         self.session.commit()
 
 
-def get_fasta_input(germline_seq, sequences, min_mut_copies, min_mut_samples):
-    seqs = {}
+def get_tree_input(germline_seq, sequences, min_mut_copies, min_mut_samples):
+    """Gets the sequences to build a clone's tree from with mutations that
+    do not meet the thresholds reverted to the germline.
+
+    :returns: An ordered dictionary from name to sequence, starting with the
+        germline, and the set of removed mutations
+    :rtype: tuple
+
+    """
+    seqs = OrderedDict()
     mut_counts = {}
     for seq in sequences:
         seqs[seq.ai] = seq.clone_sequence
@@ -112,14 +121,23 @@ def get_fasta_input(germline_seq, sequences, min_mut_copies, min_mut_samples):
     for seq_id, seq in seqs.items():
         seqs[seq_id] = remove_muts(seq, removed_muts, germline_seq)
 
-    in_data = '>germline\n{}\n'.format(germline_seq)
+    tree_input = OrderedDict([('germline', germline_seq)])
     for seq_id, seq in seqs.items():
-        in_data += '>{}\n{}\n'.format(seq_id, seq)
-    return in_data, removed_muts
+        tree_input[str(seq_id)] = seq
+    return tree_input, removed_muts
+
+
+def format_fasta(seqs):
+    return ''.join('>{}\n{}\n'.format(name, seq)
+                   for name, seq in seqs.items())
 
 
 def add_tree_metadata(session, newick, germline_seq, removed_muts):
-    tree = ete3.Tree(newick)
+    # Tree engines which run in-process return the tree itself
+    if isinstance(newick, ete3.TreeNode):
+        tree = newick
+    else:
+        tree = ete3.Tree(newick)
     for node in tree.traverse():
         if node.name not in ('NoName', 'germline', ''):
             seq = session.query(Sequence).filter(
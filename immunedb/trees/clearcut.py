@@ -6,7 +6,8 @@ import ete3
 import immunedb.common.config as config
 from immunedb.common.models import Clone
 import immunedb.common.modification_log as mod_log
-from immunedb.trees import instantiate_node, LineageWorker
+from immunedb.trees import format_fasta, instantiate_node, LineageWorker
+import immunedb.trees.nj as nj
 import immunedb.util.concurrent as concurrent
 from immunedb.util.log import logger
 
@@ -17,6 +18,23 @@ def get_newick(fasta_input):
     return proc.communicate(input=fasta_input)[0]
 
 
+# Trees with at most this many taxa, including the germline, have only one
+# unrooted topology so they are built in-process instead of with clearcut
+MAX_IN_PROCESS_TAXA = 3
+
+
+def get_tree(seqs):
+    if len(seqs) <= MAX_IN_PROCESS_TAXA:
+        return nj.get_tree(seqs)
+    return get_newick(format_fasta(seqs))
+
+
+TREE_ENGINES = {
+    'clearcut': get_tree,
+    'nj': nj.get_tree,
+}
+
+
 def minimize_tree(tree):
     tree.set_outgroup('germline')
     tree.search_nodes(name='germline')[0].delete()
@@ -111,31 +129,34 @@ def are_null_nodes(tree):
 
 def run_clearcut(session, args):
     if args.clone_ids is not None:
-        clones = session.query(Clone.id).filter(
+        clones = session.query(Clone.id, Clone.overall_unique_cnt).filter(
             Clone.id.in_(args.clone_ids))
     else:
         if args.subject_ids is not None:
-            clones = session.query(Clone.id).filter(
+            clones = session.query(
+                Clone.id, Clone.overall_unique_cnt
+            ).filter(
                 Clone.subject_id.in_(args.subject_ids))
         else:
-            clones = session.query(Clone.id)
+            clones = session.query(Clone.id, Clone.overall_unique_cnt)
 
     if not args.force:
         clones = clones.filter(Clone.tree.is_(None))
-    clones = [c.id for c in clones]
+    clones = clones.all()
     mod_log.make_mod('clone_tree', session=session, commit=True,
                      info=vars(args))
 
-    tasks = concurrent.TaskQueue()
+    tasks = concurrent.TaskQueue(status_file=args.status_file)
 
     logger.info('Creating task queue for clones')
-    for clone_id in clones:
-        tasks.add_task(clone_id)
+    for clone in clones:
+        # Building a tree takes at least quadratic time in its size
+        tasks.add_task(clone.id, cost=(clone.overall_unique_cnt or 0) ** 2)
 
     for _ in range(0, args.nproc):
         session = config.init_db(args.db_config)
         tasks.add_worker(LineageWorker(
-            session, get_newick,
+            session, TREE_ENGINES[args.tree_engine],
             args.min_mut_copies, args.min_mut_samples,
             args.min_seq_copies,
             args.min_seq_samples,
@@ -0,0 +1,90 @@
+import ete3
+import numpy as np
+
+
+def distance_matrix(seqs):
+    """Gets the pairwise hamming distances between equal length sequences
+    where, like ``dnautils.hamming``, positions with an N or gap in either
+    sequence are not counted.
+
+    :param list seqs: The sequences
+
+    :returns: The distance matrix
+    :rtype: numpy.ndarray
+
+    """
+    encoded = np.frombuffer(''.join(seqs).encode('ascii'),
+                            dtype=np.uint8).reshape(len(seqs), -1)
+    wildcards = (encoded == ord('N')) | (encoded == ord('-'))
+    dists = np.zeros((len(seqs), len(seqs)), dtype=np.float64)
+    for i in range(len(seqs)):
+        dists[i] = (
+            (encoded != encoded[i]) & ~wildcards & ~wildcards[i]
+        ).sum(axis=1)
+    return dists
+
+
+def neighbor_join(names, dists):
+    """Builds an unrooted tree with the neighbor-joining algorithm.
+
+    :param list names: The names of the taxa
+    :param numpy.ndarray dists: The pairwise distances between the taxa
+
+    :returns: The tree with one leaf per taxon
+    :rtype: ete3.Tree
+
+    """
+    nodes = [ete3.Tree(name=name) for name in names]
+    dists = np.array(dists, dtype=np.float64)
+    while len(nodes) > 3:
+        n = len(nodes)
+        totals = dists.sum(axis=1)
+        q = (n - 2) * dists - totals[:, None] - totals[None, :]
+        np.fill_diagonal(q, np.inf)
+        i, j = sorted(np.unravel_index(np.argmin(q), q.shape))
+
+        i_len = (dists[i, j] / 2 +
+                 (totals[i] - totals[j]) / (2 * (n - 2)))
+        parent = ete3.Tree()
+        parent.add_child(nodes[i], dist=max(i_len, 0))
+        parent.add_child(nodes[j], dist=max(dists[i, j] - i_len, 0))
+
+        joined = (dists[i] + dists[j] - dists[i, j]) / 2
+        keep = [k for k in range(n) if k not in (i, j)]
+        dists = np.vstack((
+            np.hstack((dists[np.ix_(keep, keep)], joined[keep, None])),
+            np.append(joined[keep], 0)
+        ))
+        nodes = [nodes[k] for k in keep] + [parent]
+
+    tree = ete3.Tree()
+    if len(nodes) == 3:
+        # The branch lengths of the final star follow from the three
+        # remaining pairwise distances
+        for k in range(3):
+            a, b = [m for m in range(3) if m != k]
+            tree.add_child(nodes[k], dist=max(
+                (dists[k, a] + dists[k, b] - dists[a, b]) / 2, 0))
+    else:
+        for node in nodes:
+            tree.add_child(node, dist=dists[0, 1] / 2 if len(nodes) == 2
+                           else 0)
+    return tree
+
+
+def get_tree(seqs):
+    """Builds a neighbor-joining tree in-process from the sequences returned
+    by :py:func:`immunedb.trees.get_tree_input`.  Unlike
+    :py:func:`immunedb.trees.clearcut.get_newick` it returns the tree rather
+    than Newick text.
+
+    :param dict seqs: The sequences keyed by name
+
+    :returns: The tree
+    :rtype: ete3.Tree
+
+    """
+    if not seqs:
+        return None
+    return neighbor_join(list(seqs.keys()),
+                         distance_matrix(list(seqs.values())))
@@ -1,9 +1,18 @@
+import collections
+import contextlib
+import datetime
 import functools
+import json
+import math
 import multiprocessing as mp
+import os
+import queue
 import traceback
 import logging
 import time
 
+import numpy as np
+
 from immunedb.util.log import logger
 
 
@@ -27,25 +36,190 @@ class Worker(object):
         pass
 
 
+# Chunks of tasks are sized so a worker takes about this long to run each
+TARGET_CHUNK_SECONDS = 1.0
+# The most tasks which are sent to a worker in one chunk
+MAX_CHUNK_SIZE = 1000
+# The weight of the latest chunk in the estimated time per unit of cost
+LATENCY_SMOOTHING = 0.2
+# How often to check that workers with outstanding chunks are still alive
+WORKER_CHECK_SECONDS = 10
+# How often progress is logged and the status file is written
+PROGRESS_SECONDS = 60
+# The number of running tasks included in progress reports
+NUM_SLOWEST_RUNNING = 5
+
+
+class TaskProgress(object):
+    """Tracks the tasks completed by the workers of a :py:class:`TaskQueue`
+    and reports the overall progress, throughput and estimated time
+    remaining.
+
+    :param int num_tasks: The total number of tasks
+    :param float total_cost: The total cost of the tasks
+    :param int num_workers: The number of workers running the tasks
+    :param str status_file: If specified, a path to which each report is
+        written as JSON
+
+    """
+    def __init__(self, num_tasks, total_cost, num_workers, status_file=None):
+        self.num_tasks = num_tasks
+        self.total_cost = total_cost
+        self.num_workers = num_workers
+        self.status_file = status_file
+        self.started = time.time()
+        self.completed = 0
+        self.completed_cost = 0
+        self.durations = []
+
+    def record(self, cost, durations):
+        """Records a completed chunk of tasks.
+
+        :param float cost: The total cost of the tasks in the chunk
+        :param list durations: The number of seconds each task took
+
+        """
+        self.completed += len(durations)
+        self.completed_cost += cost
+        self.durations.extend(durations)
+
+    def get_status(self, running=(), complete=False):
+        """Gets the current progress.
+
+        :param list running: The ``(worker_id, task, seconds)`` of running
+            tasks
+        :param bool complete: If all tasks have completed
+
+        :returns: The progress of the tasks
+        :rtype: dict
+
+        """
+        now = time.time()
+        elapsed = now - self.started
+        if complete:
+            eta = 0
+        elif self.completed_cost > 0:
+            # The tasks are not run in a random order so the estimate uses
+            # the cost of tasks rather than how many have completed
+            eta = elapsed * (self.total_cost - self.completed_cost) / (
+                self.completed_cost)
+        else:
+            eta = None
+
+        if len(self.durations) > 0:
+            task_seconds = dict(zip(
+                ('p50', 'p90', 'p99', 'max'),
+                (round(float(p), 3) for p in np.percentile(
+                    self.durations, (50, 90, 99, 100)))
+            ))
+        else:
+            task_seconds = None
+
+        return {
+            'started': datetime.datetime.fromtimestamp(
+                self.started).isoformat(),
+            'updated': datetime.datetime.fromtimestamp(now).isoformat(),
+            'complete': complete,
+            'workers': self.num_workers,
+            'total_tasks': self.num_tasks,
+            'completed_tasks': self.completed,
+            'percent_complete': round(
+                100 * self.completed / max(1, self.num_tasks), 1),
+            'elapsed_seconds': round(elapsed, 1),
+            'tasks_per_second': round(self.completed / max(elapsed, 1e-9),
+                                      3),
+            'eta_seconds': None if eta is None else round(eta, 1),
+            'task_seconds': task_seconds,
+            'slowest_running': [{
+                'worker': worker_id,
+                'task': task,
+                'seconds': round(seconds, 1)
+            } for worker_id, task, seconds in sorted(
+                running, key=lambda r: r[2], reverse=True
+            )[:NUM_SLOWEST_RUNNING]],
+        }
+
+    def report(self, running=(), complete=False):
+        """Logs the current progress and writes it to the status file if
+        one was specified.
+
+        :param list running: The ``(worker_id, task, seconds)`` of running
+            tasks
+        :param bool complete: If all tasks have completed
+
+        """
+        status = self.get_status(running, complete)
+        msg = 'Completed {}/{} tasks ({}%) at {} tasks/sec'.format(
+            status['completed_tasks'], status['total_tasks'],
+            status['percent_complete'], status['tasks_per_second'])
+        if status['task_seconds'] is not None:
+            msg += ', task seconds p50={p50} p90={p90} p99={p99}'.format(
+                **status['task_seconds'])
+        if not complete and status['eta_seconds'] is not None:
+            msg += ', ETA {}'.format(datetime.timedelta(
+                seconds=int(status['eta_seconds'])))
+        logger.info(msg)
+        for task in status['slowest_running']:
+            logger.info('Worker {} has been running {} for {} seconds'.format(
+                task['worker'], task['task'], task['seconds']))
+
+        if self.status_file is not None:
+            # The status is written to a temporary file first so it is never
+            # read partially written
+            tmp_path = '{}.tmp'.format(self.status_file)
+            with open(tmp_path, 'w') as fh:
+                json.dump(status, fh, indent=4)
+            os.replace(tmp_path, self.status_file)
+
+
 class TaskQueue(object):
-    def __init__(self):
-        self._task_queue = mp.JoinableQueue()
+    """A queue of tasks run by forked worker processes.
+
+    Tasks added with a ``cost``, an estimate of how long they take relative
+    to one another such as the number of sequences they process, are run
+    most costly first so they do not start last and leave a single worker
+    running long after the rest finish.  Tasks without a cost have a cost of
+    one and run first, in the order they are added.  Tasks with a cost of
+    zero or less are also counted as one so that the time they take is still
+    measured.
+
+    Workers are sent chunks of tasks and acknowledge each chunk once it is
+    complete.  Each chunk is sized from the time taken by previous chunks so
+    that it takes about ``TARGET_CHUNK_SECONDS``, meaning many small tasks
+    are sent together while large ones are sent alone.
+
+    Progress is logged every ``PROGRESS_SECONDS`` with a
+    :py:class:`TaskProgress`.
+
+    :param str status_file: If specified, a path to which the progress is
+        written as JSON
+
+    """
+    def __init__(self, status_file=None):
+        self._tasks = []
         self._num_tasks = 0
         self._workers = []
+        self._worker_queues = []
+        self._ack_queue = mp.Queue()
+        self._secs_per_cost = None
+        self._status_file = status_file
+        self._running = None
 
-    def add_task(self, args):
+    def add_task(self, args, cost=None):
         self._num_tasks += 1
-        self._task_queue.put(args)
+        self._tasks.append((cost, args))
 
     def add_tasks(self, tasks):
         for i, task in enumerate(tasks):
             self.add_task(task)
 
     def add_worker(self, worker):
+        self._worker_queues.append(mp.Queue())
         self._workers.append(
             mp.Process(
                 target=self._func_wrap,
-                args=(len(self._workers) + 1, worker)
+                args=(len(self._workers) + 1, worker,
+                      self._worker_queues[-1])
             )
         )
 
@@ -54,45 +228,157 @@ class TaskQueue(object):
             self.add_worker(worker_cls(*args, **kwargs))
 
     def join(self):
-        self._task_queue.join()
+        pending = self._ordered_tasks()
+        remaining = sum(cost for cost, _ in pending)
+        progress = TaskProgress(len(pending), remaining, len(self._workers),
+                                self._status_file)
+        in_flight = {}
 
-    def signal_end(self):
-        for _ in self._workers:
-            self.add_task(None)
+        def dispatch(worker_id):
+            nonlocal remaining
+            if len(pending) > 0:
+                chunk, cost = self._next_chunk(pending, remaining)
+                remaining -= cost
+                in_flight[worker_id] = (cost, chunk)
+                self._worker_queues[worker_id - 1].put(chunk)
 
-    def start(self, block=True):
-        if block:
-            self.signal_end()
+        for worker_id in range(1, len(self._workers) + 1):
+            dispatch(worker_id)
+        last_report = time.time()
+        while len(in_flight) > 0:
+            if time.time() - last_report >= PROGRESS_SECONDS:
+                progress.report(self._get_running(in_flight))
+                last_report = time.time()
+            try:
+                worker_id, durations = self._ack_queue.get(
+                    timeout=WORKER_CHECK_SECONDS)
+            except queue.Empty:
+                for worker_id in list(in_flight):
+                    if not self._workers[worker_id - 1].is_alive():
+                        logger.error(
+                            'Worker {} exited before completing its '
+                            'tasks'.format(worker_id))
+                        del in_flight[worker_id]
+                continue
+            cost, _ = in_flight.pop(worker_id)
+            self._record_latency(cost, sum(durations))
+            progress.record(cost, durations)
+            dispatch(worker_id)
+
+        for worker_queue in self._worker_queues:
+            worker_queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        progress.report(complete=True)
 
+    def start(self, block=True):
+        # Each worker records the index in its chunk and start time of the
+        # task it is running here so the parent can report on them
+        self._running = mp.RawArray('d', 2 * len(self._workers))
         for worker in self._workers:
             worker.start()
         if block:
             self.join()
 
-    def _func_wrap(self, worker_id, worker):
+    def _get_running(self, in_flight):
+        now = time.time()
+        running = []
+        for worker_id, (_, chunk) in in_flight.items():
+            index, started = self._running[2 * (worker_id - 1):
+                                           2 * worker_id]
+            if started > 0 and int(index) < len(chunk):
+                running.append((worker_id, str(chunk[int(index)])[:100],
+                                now - started))
+        return running
+
+    def _ordered_tasks(self):
+        uncosted = [(1, args) for cost, args in self._tasks if cost is None]
+        costed = sorted([(cost if cost > 0 else 1, args)
+                         for cost, args in self._tasks if cost is not None],
+                        key=lambda t: t[0], reverse=True)
+        self._tasks = []
+        return collections.deque(uncosted + costed)
+
+    def _next_chunk(self, pending, remaining):
+        """Removes the next chunk of tasks from ``pending``.  Until the
+        time taken per unit of cost is known, chunks have a single task.
+        After that they are sized to take ``TARGET_CHUNK_SECONDS`` but are
+        never more than an even share of the remaining cost between the
+        workers, so the final tasks are spread out.
+
+        :param deque pending: The ``(cost, args)`` of the remaining tasks
+        :param float remaining: The total cost of the remaining tasks
+
+        :returns: The arguments of the tasks in the chunk and their cost
+        :rtype: tuple
+
+        """
+        if self._secs_per_cost is None:
+            max_cost = 0
+        else:
+            max_cost = min(
+                TARGET_CHUNK_SECONDS / max(self._secs_per_cost, 1e-9),
+                remaining / max(1, len(self._workers)))
+
+        chunk, chunk_cost = [], 0
+        while len(pending) > 0 and len(chunk) < MAX_CHUNK_SIZE:
+            cost = pending[0][0]
+            if len(chunk) > 0 and chunk_cost + cost > max_cost:
+                break
+            chunk.append(pending.popleft()[1])
+            chunk_cost += cost
+        return chunk, chunk_cost
+
+    def _record_latency(self, cost, elapsed):
+        secs_per_cost = elapsed / cost
+        if self._secs_per_cost is None:
+            self._secs_per_cost = secs_per_cost
+        else:
+            self._secs_per_cost += LATENCY_SMOOTHING * (
+                secs_per_cost - self._secs_per_cost)
+
+    def _func_wrap(self, worker_id, worker, worker_queue):
         worker._worker_id = worker_id
+        offset = 2 * (worker_id - 1)
         while True:
-            try:
-                args = self._task_queue.get()
-                if args is None:
-                    self._task_queue.task_done()
-                    break
-                else:
+            chunk = worker_queue.get()
+            if chunk is None:
+                break
+            durations = []
+            for i, args in enumerate(chunk):
+                start = time.time()
+                self._running[offset:offset + 2] = [i, start]
+                try:
                     worker.do_task(args)
-                    self._task_queue.task_done()
-            except Exception:
-                worker.error(
-                    'The task was not completed because:\n{}'.format(
-                        traceback.format_exc()))
-                self._task_queue.task_done()
+                except Exception:
+                    worker.error(
+                        'The task was not completed because:\n{}'.format(
+                            traceback.format_exc()))
+                durations.append(time.time() - start)
+            self._running[offset + 1] = 0
+            self._ack_queue.put((worker_id, durations))
         worker.cleanup()
 
     def num_tasks(self):
         return self._num_tasks
 
 
-def subcaller(func, data, i):
-    return func(data[i])
+# The processing function and input of the active process_data pool.  They
+# are set in the parent before the pool is created so that forked workers
+# inherit them (e.g. germlines and alignments) through copy-on-write memory
+# rather than each receiving pickled copies.
+_process_func = None
+_process_input = None
+
+
+def _set_process_state(func, input_data=None):
+    global _process_func, _process_input
+    _process_func = func
+    _process_input = input_data
+
+
+def subcaller(data, i):
+    return _process_func((_process_input if data is None else data)[i])
 
 
 # V2 of multiprocessing
@@ -102,25 +388,42 @@ def process_data(input_data, process_func, aggregate_func, nproc,
         start = time.time()
         input_data = input_data(**generate_args)
         logger.info('Generate time: {}'.format(time.time() - start))
+    if not isinstance(input_data, list):
+        input_data = list(input_data)
 
-    with mp.Manager() as manager:
-        proxy_data = manager.list(input_data)
-        pool = mp.Pool(processes=nproc)
-        f = functools.partial(
-            subcaller,
-            functools.partial(process_func, **process_args),
-            proxy_data
-        )
+    func = functools.partial(process_func, **process_args)
+    with contextlib.ExitStack() as stack:
+        if mp.get_start_method() == 'fork':
+            _set_process_state(func, input_data)
+            pool = mp.Pool(processes=nproc)
+            f = functools.partial(subcaller, None)
+        else:
+            # Without fork, each worker receives one pickled copy of the
+            # function at startup and reads input through a manager
+            manager = stack.enter_context(mp.Manager())
+            proxy_data = manager.list(input_data)
+            pool = mp.Pool(processes=nproc, initializer=_set_process_state,
+                           initargs=(func,))
+            f = functools.partial(subcaller, proxy_data)
         start = time.time()
-        logger.info('Waiting on pool {}'.format(process_func.__name__))
-
-        res = [r for r in pool.map(f, range(len(proxy_data))) if r is not None]
-        pool.close()
-    logger.info('Pool done: {}'.format(time.time() - start))
+        logger.info('Waiting on pool {} with aggregation {}'.format(
+            process_func.__name__, aggregate_func.__name__))
 
-    start = time.time()
-    logger.info('Waiting on aggregation {}'.format(aggregate_func.__name__))
-    ret = aggregate_func(res, **aggregate_args)
-    logger.info('Done aggregation: {}'.format(time.time() - start))
+        # Results are aggregated as they arrive, in input order, rather than
+        # being collected into a list first
+        try:
+            chunksize = max(1, math.ceil(len(input_data) / (4 * nproc)))
+            ret = aggregate_func(
+                (r for r in pool.imap(f, range(len(input_data)), chunksize)
+                 if r is not None),
+                **aggregate_args)
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            _set_process_state(None)
+    logger.info('Pool and aggregation done: {}'.format(time.time() - start))
 
     return ret
@@ -0,0 +1,197 @@
+import bz2
+import gzip
+import io
+import lzma
+import os
+import queue
+import sys
+import threading
+
+STDIN_PATH = '-'
+BLOCK_SIZE = 1 << 20
+
+COMPRESSION_MAGIC = (
+    (b'\x1f\x8b', 'gzip'),
+    (b'BZh', 'bz2'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'\x28\xb5\x2f\xfd', 'zstd'),
+)
+COMPRESSION_EXTENSIONS = ('.gz', '.bz2', '.xz', '.zst')
+SEQUENCE_EXTENSIONS = {
+    '.fasta': 'fasta',
+    '.fa': 'fasta',
+    '.fna': 'fasta',
+    '.fastq': 'fastq',
+    '.fq': 'fastq',
+}
+
+
+def _decompressor(raw, compression):
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=raw)
+    if compression == 'bz2':
+        return bz2.BZ2File(raw)
+    if compression == 'xz':
+        return lzma.LZMAFile(raw)
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError('Reading zstd compressed input requires the '
+                         'zstandard package')
+    return zstandard.ZstdDecompressor().stream_reader(raw)
+
+
+def _fill_queue(handle, blocks, stop):
+    def put(item):
+        # Waits for space in the queue unless the reader has been closed
+        while not stop.is_set():
+            try:
+                blocks.put(item, timeout=.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    try:
+        for block in iter(lambda: handle.read(BLOCK_SIZE), b''):
+            if not put(block):
+                break
+    except Exception as e:
+        put(e)
+    finally:
+        handle.close()
+        put(None)
+
+
+class ThreadedReader(io.RawIOBase):
+    """A binary stream which reads ``handle`` in a background thread so that
+    decompression overlaps with parsing of already decompressed blocks.
+    Closing the stream stops the thread even if not all of ``handle`` has
+    been read.
+
+    :param file handle: The binary stream to read from
+    :param int max_blocks: The maximum number of blocks to buffer
+
+    """
+    def __init__(self, handle, max_blocks=16):
+        self._blocks = queue.Queue(maxsize=max_blocks)
+        self._buffer = b''
+        self._done = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=_fill_queue,
+                                        args=(handle, self._blocks,
+                                              self._stop))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer and not self._done:
+            block = self._blocks.get()
+            if block is None:
+                self._done = True
+            elif isinstance(block, Exception):
+                self._done = True
+                raise block
+            else:
+                self._buffer = block
+        size = min(len(b), len(self._buffer))
+        b[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self._stop.set()
+            self._buffer = b''
+            # Free any buffered blocks and unblock the thread if it is
+            # waiting for space in the queue
+            while True:
+                try:
+                    self._blocks.get_nowait()
+                except queue.Empty:
+                    break
+        super(ThreadedReader, self).close()
+
+
+def input_path(directory, file_name):
+    """Gets the path of an input file listed in a metadata file.
+
+    :param str directory: The directory containing the input files
+    :param str file_name: The file name, or ``-`` for standard input
+
+    :returns: The path to the file, or ``-`` for standard input
+    :rtype: str
+
+    """
+    if file_name == STDIN_PATH:
+        return file_name
+    return os.path.join(directory, file_name)
+
+
+def input_exists(path):
+    """Determines if an input path can be read, including named pipes and
+    standard input.
+
+    :param str path: The path to the file or ``-``
+
+    :returns: If the input exists
+    :rtype: bool
+
+    """
+    return path == STDIN_PATH or (os.path.exists(path) and
+                                  not os.path.isdir(path))
+
+
+def open_input(path):
+    """Opens a possibly compressed input file for reading as text.
+    Compression is detected from the leading bytes so gzip, bzip2 and xz
+    files (and zstd, if the ``zstandard`` package is installed) are read
+    regardless of extension.  Compressed input is decompressed in a
+    background thread.  A path of ``-`` reads from standard input, and named
+    pipes can be read like any other path.
+
+    :param str path: The path to the file or ``-``
+
+    :returns: A text stream of the decompressed input
+    :rtype: file
+
+    """
+    if path == STDIN_PATH:
+        raw = io.BufferedReader(io.FileIO(os.dup(sys.stdin.fileno()), 'rb'))
+    else:
+        raw = open(path, 'rb')
+
+    head = raw.peek(max(len(m) for m, _ in COMPRESSION_MAGIC))
+    for magic, compression in COMPRESSION_MAGIC:
+        if head.startswith(magic):
+            raw = io.BufferedReader(
+                ThreadedReader(_decompressor(raw, compression)),
+                buffer_size=BLOCK_SIZE)
+            break
+    return io.TextIOWrapper(raw, encoding='utf-8', errors='replace')
+
+
+def sequence_format(path, handle):
+    """Determines if a sequence file is FASTA or FASTQ from its extension,
+    ignoring any compression extension.  If the extension is not recognized
+    the first character of ``handle`` is used instead.
+
+    :param str path: The path to the file
+    :param file handle: The text stream returned by :py:func:`open_input`
+
+    :returns: Either ``fasta`` or ``fastq``
+    :rtype: str
+
+    """
+    name = path.lower()
+    for ext in COMPRESSION_EXTENSIONS:
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+            break
+    fmt = SEQUENCE_EXTENSIONS.get(os.path.splitext(name)[1])
+    if fmt is not None:
+        return fmt
+    return 'fasta' if handle.buffer.peek(1)[:1] == b'>' else 'fastq'
@@ -1,7 +1,14 @@
-from collections import Counter
 import itertools
+import math
+import os
+import tempfile
 
 import dnautils
+import numpy as np
+import sqlalchemy
+import sqlalchemy.exc
+
+from immunedb.util.log import logger
 
 
 def chunks(l, n):
@@ -23,7 +30,151 @@ def yield_limit(qry, pk_attr, maxrq=5000):
         firstid = pk_attr.__get__(rec, pk_attr) if rec else None
 
 
-def bulk_add(session, objs, chunk_size=100, flush=True):
+BULK_METHODS = ('orm', 'executemany', 'infile')
+_BULK_FALLBACKS = {'infile': 'executemany', 'executemany': 'orm'}
+# MySQL error codes raised when a bulk method cannot be used at all, rather
+# than because of the rows being inserted
+_UNAVAILABLE_ERRORS = {
+    1148,  # ER_NOT_ALLOWED_COMMAND: local_infile is disabled
+    1227,  # ER_SPECIFIC_ACCESS_DENIED_ERROR: a privilege is missing
+    1153,  # ER_NET_PACKET_TOO_LARGE: exceeds max_allowed_packet
+    2068,  # CR_LOAD_DATA_LOCAL_INFILE_REJECTED: rejected by the client
+    3948,  # ER_CLIENT_LOCAL_FILES_DISABLED: local_infile is disabled
+}
+
+
+def _method_unavailable(error):
+    args = getattr(error.orig, 'args', ())
+    return len(args) > 0 and args[0] in _UNAVAILABLE_ERRORS
+
+
+def _column_rows(objs):
+    """Gets the columns of the table to which ``objs`` belong along with a
+    row of values for each.  Attributes an instance does not set are given
+    their column's default, and columns which no instance sets and which
+    have no Python-side default are left to the database.
+
+    """
+    mapper = sqlalchemy.inspect(type(objs[0]))
+    columns = [
+        (attr.key, attr.columns[0]) for attr in mapper.column_attrs
+        if attr.columns[0].default is not None or
+        any(attr.key in o.__dict__ for o in objs)
+    ]
+
+    def get_default(column):
+        # Callable defaults are called for each row, as the ORM does
+        if column.default is not None:
+            if column.default.is_callable:
+                return lambda: column.default.arg(None)
+            value = column.default.arg
+        elif (column.server_default is not None and
+                isinstance(column.server_default.arg, str)):
+            value = column.server_default.arg
+        else:
+            value = None
+        return lambda: value
+
+    defaults = {key: get_default(column) for key, column in columns}
+    return columns, [
+        {
+            column.key: o.__dict__[key] if key in o.__dict__ else
+            defaults[key]() for key, column in columns
+        } for o in objs
+    ]
+
+
+def _infile_value(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, float):
+        if not math.isfinite(value):
+            raise ValueError('Cannot insert non-finite value {}'.format(
+                value))
+        return repr(value)
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace(
+        '\n', '\\n').replace('\r', '\\r').replace('\0', '\\0')
+
+
+def _insert_executemany(session, objs, chunk_size):
+    table = type(objs[0]).__table__
+    _, rows = _column_rows(objs)
+    for chunk in chunks(rows, chunk_size):
+        session.execute(table.insert(), chunk)
+
+
+def _insert_infile(session, objs):
+    table = type(objs[0]).__table__
+    columns, rows = _column_rows(objs)
+    fh = tempfile.NamedTemporaryFile(mode='w', suffix='.tsv', delete=False)
+    try:
+        with fh:
+            for row in rows:
+                fh.write('\t'.join(_infile_value(row[c.key])
+                                   for _, c in columns))
+                fh.write('\n')
+        session.execute(sqlalchemy.text(
+            'LOAD DATA LOCAL INFILE :path INTO TABLE `{}` CHARACTER SET utf8 '
+            '({})'.format(table.name, ', '.join(
+                '`{}`'.format(c.name) for _, c in columns))),
+            {'path': fh.name})
+    finally:
+        os.remove(fh.name)
+    # LOAD DATA truncates or converts invalid values with a warning rather
+    # than failing, so any warning means rows were not loaded as given
+    warnings = [
+        w for w in session.execute(sqlalchemy.text('SHOW WARNINGS'))
+        if w[0] != 'Note'
+    ]
+    if len(warnings) > 0:
+        raise ValueError('Rows were altered when loaded into {}: {}'.format(
+            table.name, '; '.join(w[2] for w in warnings[:5])))
+
+
+def bulk_add(session, objs, chunk_size=100, flush=True, method='orm'):
+    """Inserts a list of model instances of the same type.
+
+    :param Session session: The database session
+    :param list objs: The instances to insert
+    :param int chunk_size: The number of instances to insert at once with the
+        ``orm`` method
+    :param bool flush: If the session should be flushed after each chunk with
+        the ``orm`` method
+    :param str method: How to insert the rows: ``orm`` uses
+        ``bulk_insert_mappings``, ``executemany`` sends large multi-row
+        inserts and ``infile`` stages rows in a temporary file loaded with
+        ``LOAD DATA LOCAL INFILE``, which requires ``local_infile`` to be set
+        in the database config and enabled on the server.  If the database
+        does not allow a method the next fastest one is used instead for the
+        rest of the session.  Errors caused by the rows themselves are
+        raised.
+
+    """
+    if not objs:
+        return
+
+    unavailable = session.info.setdefault('unavailable_bulk_methods', set())
+    while method != 'orm':
+        if method not in unavailable:
+            try:
+                with session.begin_nested():
+                    if method == 'infile':
+                        _insert_infile(session, objs)
+                    else:
+                        _insert_executemany(session, objs,
+                                            max(chunk_size, 5000))
+                return
+            except sqlalchemy.exc.DBAPIError as e:
+                if not _method_unavailable(e):
+                    raise
+                logger.warning(
+                    'Unable to insert rows with {}, falling back to {}: '
+                    '{}'.format(method, _BULK_FALLBACKS[method], e.orig))
+                unavailable.add(method)
+        method = _BULK_FALLBACKS[method]
+
     for i in range(0, len(objs), chunk_size):
         session.bulk_insert_mappings(
             type(objs[0]),
@@ -46,8 +197,26 @@ def consensus(strings):
     :rtype: str
 
     """
-    chrs = [Counter(chars).most_common(1)[0][0] for chars in zip(*strings)]
-    return ''.join(chrs)
+    length = min((len(s) for s in strings), default=0)
+    if length == 0:
+        return ''
+    chars = np.frombuffer(
+        ''.join(s[:length] for s in strings).encode('ascii'),
+        dtype=np.uint8).reshape(len(strings), length)
+
+    # The most common character in each column, with ties broken by the
+    # character which occurs first in the column
+    best = np.zeros(length, dtype=np.uint8)
+    best_score = np.full(length, -1, dtype=np.int64)
+    for char in np.unique(chars):
+        matches = chars == char
+        first = np.where(matches.any(axis=0), matches.argmax(axis=0),
+                         len(strings))
+        score = matches.sum(axis=0) * (len(strings) + 1) - first
+        better = score > best_score
+        best[better] = char
+        best_score[better] = score[better]
+    return best.tobytes().decode('ascii')
 
 
 def get_regions(insertions):
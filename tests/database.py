@@ -0,0 +1,42 @@
+import contextlib
+import itertools
+from unittest import mock
+
+from sqlalchemy import ColumnDefault, create_engine
+from sqlalchemy.dialects.mysql import MEDIUMTEXT
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import sessionmaker
+
+from immunedb.common.models import Base, Sequence
+
+
+@compiles(MEDIUMTEXT, 'sqlite')
+def compile_mediumtext(element, compiler, **kwargs):
+    return 'TEXT'
+
+
+def get_engine(path=None):
+    """Creates a SQLite database with every table for tests which do not
+    need MySQL.  SQLite cannot auto-increment a column in a composite primary
+    key, so sequences must be given an ``ai`` or be inserted within
+    ``numbered_sequences``.
+
+    """
+    engine = create_engine('sqlite:///{}'.format(path or ''))
+    with mock.patch.object(Sequence.__table__.c.ai, 'autoincrement', False):
+        Base.metadata.create_all(engine)
+    return engine
+
+
+def get_session(engine=None):
+    return sessionmaker(bind=engine or get_engine())()
+
+
+@contextlib.contextmanager
+def numbered_sequences():
+    """Numbers the ``ai`` of inserted sequences in place of MySQL's
+    auto-increment."""
+    counter = itertools.count(1)
+    with mock.patch.object(Sequence.__table__.c.ai, 'default',
+                           ColumnDefault(lambda context: next(counter))):
+        yield
@@ -138,6 +138,8 @@ class BaseTest(object):
                     v_germlines='tests/data/germlines/imgt_human_v.fasta',
                     j_germlines='tests/data/germlines/imgt_human_j.fasta',
                     temp='/tmp',
+                    aligner='bowtie2',
+                    compare_aligners=False,
                     upstream_of_cdr3=31,
                     max_deletions=5,
                     max_insertions=5,
@@ -172,7 +174,9 @@ class BaseTest(object):
             run_collapse(
                 self.session,
                 NamespaceMimic(
-                    subject_ids=None
+                    subject_ids=None,
+                    incremental=False,
+                    status_file=None
                 )
             )
             self.session.commit()
@@ -203,7 +207,9 @@ class BaseTest(object):
                     max_padding=None,
                     regen=False,
                     subclones=False,
-                    gene=None
+                    gene=None,
+                    prefetch=False,
+                    status_file=None
                 )
             )
             self.session.commit()
@@ -229,7 +235,8 @@ class BaseTest(object):
                 NamespaceMimic(
                     clone_ids=None,
                     subject_ids=None,
-                    regen=False
+                    regen=False,
+                    status_file=None
                 )
             )
             self.session.commit()
@@ -283,7 +290,9 @@ class BaseTest(object):
                     min_count=1,
                     min_seq_copies=0,
                     min_samples=1,
-                    exclude_stops=False
+                    exclude_stops=False,
+                    tree_engine='clearcut',
+                    status_file=None
                 )
             )
             self.session.commit()
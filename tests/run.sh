@@ -20,6 +20,15 @@ fi
 setup
 coverage erase
 coverage run --source=immunedb -p -m nose tests/tests_parser.py
+coverage run --source=immunedb -p -m nose tests/tests_swalign.py
+coverage run --source=immunedb -p -m nose tests/tests_clones.py
+coverage run --source=immunedb -p -m nose tests/tests_nj.py
+coverage run --source=immunedb -p -m nose tests/tests_concurrent.py
+coverage run --source=immunedb -p -m nose tests/tests_local_align.py
+coverage run --source=immunedb -p -m nose tests/tests_delimited.py
+coverage run --source=immunedb -p -m nose tests/tests_bulk_add.py
+coverage run --source=immunedb -p -m nose tests/tests_shards.py
+coverage run --source=immunedb -p -m nose tests/tests_checkpoint.py
 coverage run --source=immunedb -p -m nose tests/tests_import.py
 coverage run --source=immunedb -p -m nose tests/tests_pipeline.py
 coverage run --source=immunedb -p -m nose tests/run_server.py &
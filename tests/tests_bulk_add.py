@@ -0,0 +1,100 @@
+import unittest
+from unittest import mock
+
+import sqlalchemy.exc
+
+from immunedb.common.models import Sample, Sequence, Study
+import immunedb.util.funcs as funcs
+
+from .database import get_session, numbered_sequences
+
+
+def get_sequences():
+    seqs = []
+    for ai in range(1, 6):
+        seq = Sequence(sample_id=1, ai=ai, seq_id='seq{}'.format(ai),
+                       v_gene='IGHV1-2', j_gene='IGHJ4',
+                       sequence='ACGT\tN\\' * ai,
+                       quality=None if ai % 2 else 'I' * 6 * ai,
+                       v_mutation_fraction=ai / 7, stop=ai == 3,
+                       insertions=[(10, 3)] if ai == 4 else None)
+        # Only later instances set a value for copy_number, which has a
+        # server default
+        if ai > 2:
+            seq.copy_number = ai
+        seqs.append(seq)
+    return seqs
+
+
+class BulkAddTest(unittest.TestCase):
+    def get_rows(self, method):
+        session = get_session()
+        session.add(Sample(id=1, name='sample', study=Study(name='study')))
+        session.commit()
+        funcs.bulk_add(session, get_sequences(), method=method)
+        session.commit()
+        table = Sequence.__table__
+        return session, [
+            tuple(row) for row in session.execute(
+                table.select().order_by(table.c.ai))
+        ]
+
+    def test_methods_match(self):
+        _, orm = self.get_rows('orm')
+        _, executemany = self.get_rows('executemany')
+        assert len(orm) == 5
+        assert orm == executemany
+
+        columns = Sequence.__table__.c
+        row = dict(zip(columns.keys(), orm[0]))
+        assert row['copy_number'] == 0
+        assert row['locally_aligned'] is False
+        assert row['quality'] is None
+        assert row['clone_id'] is None
+
+    def test_columns(self):
+        columns, rows = funcs._column_rows(get_sequences())
+        keys = [key for key, _ in columns]
+        assert 'copy_number' in keys
+        assert 'locally_aligned' in keys
+        # Neither set nor defaulted in Python, so left to the database
+        assert 'clone_id' not in keys
+        assert [r['copy_number'] for r in rows] == ['0', '0', 3, 4, 5]
+        assert all(r['locally_aligned'] is False for r in rows)
+
+    def test_callable_defaults(self):
+        seqs = get_sequences()
+        for seq in seqs:
+            del seq.ai
+        with numbered_sequences():
+            _, rows = funcs._column_rows(seqs)
+        assert [r['ai'] for r in rows] == [1, 2, 3, 4, 5]
+
+    def test_infile_values(self):
+        assert funcs._infile_value(None) == '\\N'
+        assert funcs._infile_value(True) == '1'
+        assert funcs._infile_value(.25) == '0.25'
+        assert funcs._infile_value('A\tB\\C\n') == 'A\\tB\\\\C\\n'
+        for value in (float('nan'), float('inf'), float('-inf')):
+            with self.assertRaises(ValueError):
+                funcs._infile_value(value)
+
+    def test_fallback(self):
+        unavailable = sqlalchemy.exc.OperationalError(
+            'LOAD DATA', {}, Exception(1148, 'The used command is not '
+                                             'allowed with this MySQL '
+                                             'version'))
+        with mock.patch('immunedb.util.funcs._insert_infile',
+                        side_effect=unavailable) as infile:
+            session, rows = self.get_rows('infile')
+            assert len(rows) == 5
+            assert session.info['unavailable_bulk_methods'] == {'infile'}
+            # The method is only skipped for the rest of the session
+            self.get_rows('infile')
+            assert infile.call_count == 2
+
+    def test_data_errors_raised(self):
+        session, _ = self.get_rows('executemany')
+        with self.assertRaises(sqlalchemy.exc.IntegrityError):
+            funcs.bulk_add(session, get_sequences(), method='executemany')
+        assert len(session.info['unavailable_bulk_methods']) == 0
@@ -0,0 +1,80 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from immunedb.common.models import (NoResult, Sample, SampleMetadata,
+                                    SampleStats, Sequence, SequenceCollapse)
+from immunedb.identification.checkpoint import SampleCheckpoint
+from immunedb.identification.identify import setup_sample
+
+from .database import get_session
+
+META = {
+    'study_name': 'study',
+    'sample_name': 'sample/1',
+    'subject': 'subject',
+    'file_name': 'sample.fastq',
+    'tissue': 'blood',
+}
+
+
+class CheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.state_dir = os.path.join(self.dir, 'state')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_save_and_resume(self):
+        checkpoint = SampleCheckpoint(self.state_dir, META['sample_name'])
+        assert not checkpoint.started
+        checkpoint.start()
+        assert checkpoint.started
+        checkpoint.save('aligned', {'success': [1, 2], 'noresult': []})
+
+        # A new run finds the state and the saved phase
+        resumed = SampleCheckpoint.find_all(self.state_dir)
+        assert list(resumed) == [META['sample_name']]
+        checkpoint = resumed[META['sample_name']]
+        assert checkpoint.started and not checkpoint.complete
+        assert checkpoint.has('aligned')
+        assert not checkpoint.has('realigned')
+        assert checkpoint.load('aligned') == {'success': [1, 2],
+                                              'noresult': []}
+
+        checkpoint.mark_complete()
+        checkpoint = SampleCheckpoint(self.state_dir, META['sample_name'])
+        assert checkpoint.complete
+        assert not checkpoint.has('aligned')
+        assert [p for p in os.listdir(self.state_dir)
+                if p.endswith('.pickle.gz')] == []
+
+    def test_rollback(self):
+        session = get_session()
+        sample = setup_sample(session, dict(META, tissue='spleen'))
+        sample.v_ties_len = 250
+        session.add_all([
+            Sequence(sample=sample, ai=1, seq_id='seq1'),
+            SequenceCollapse(sample_id=sample.id, seq_ai=1),
+            NoResult(sample=sample, seq_id='seq2'),
+            SampleStats(sample=sample, filter_type='all', outliers=False,
+                        full_reads=False),
+        ])
+        session.commit()
+
+        checkpoint = SampleCheckpoint(self.state_dir, META['sample_name'])
+        checkpoint.rollback(session, 'other study')
+        assert session.query(Sequence).count() == 1
+
+        checkpoint.rollback(session, META['study_name'])
+        for model in (Sample, Sequence, SequenceCollapse, NoResult,
+                      SampleMetadata, SampleStats):
+            assert session.query(model).count() == 0
+
+        # The sample is created again with its current metadata
+        sample = setup_sample(session, META)
+        assert sample.v_ties_len is None
+        assert [(m.key, m.value) for m in session.query(SampleMetadata)] == [
+            ('tissue', 'blood')]
@@ -0,0 +1,248 @@
+import argparse
+import random
+import unittest
+from unittest import mock
+
+import numpy as np
+from sqlalchemy.sql.elements import TextClause
+
+import dnautils
+
+from immunedb.aggregation.clones import (BucketSequence, delete_empty_clones,
+                                         LineageClonalWorker,
+                                         PrefetchedBucket, push_clone_ids,
+                                         run_clones,
+                                         SimilarityClonalWorker,
+                                         SimilarityIndex)
+from immunedb.common.models import (Clone, Sample, Sequence, SequenceCollapse,
+                                    Study, Subject)
+import immunedb.util.lookups as lookups
+
+from .database import get_session
+
+
+def similar_to_all(seq, rest, field, min_similarity):
+    # Reference for SimilarityIndex which compares sequences one at a time
+    for comp_seq in rest:
+        dist = dnautils.hamming(
+            getattr(comp_seq, 'cdr3_' + field).replace('X', '-'),
+            getattr(seq, 'cdr3_' + field).replace('X', '-')
+        )
+        sim_frac = 1 - dist / len(comp_seq.cdr3_aa)
+        if sim_frac < min_similarity:
+            return False
+    return True
+
+
+def can_subclone(sub_seqs, parent_seqs, min_similarity, field='aa'):
+    for seq in sub_seqs:
+        if not similar_to_all(seq, parent_seqs, field, min_similarity):
+            return False
+    return True
+
+
+class MockSequence(object):
+    def __init__(self, cdr3_nt, clone_id=None):
+        self.cdr3_nt = cdr3_nt
+        self.cdr3_aa = lookups.aas_from_nts(cdr3_nt)
+        self.clone_id = clone_id
+
+
+class SimilarityIndexTest(unittest.TestCase):
+    def assign(self, seqs, field, min_similarity):
+        clones = {}
+        for seq in seqs:
+            if seq.clone_id is not None:
+                clones.setdefault(seq.clone_id, []).append(seq)
+        assignments = []
+        for seq in seqs:
+            if seq.clone_id is not None:
+                continue
+            for clone_id, members in clones.items():
+                if similar_to_all(seq, members, field, min_similarity):
+                    break
+            else:
+                clone_id = len(clones) + 100
+            clones.setdefault(clone_id, []).append(seq)
+            assignments.append(clone_id)
+        return assignments
+
+    def assign_indexed(self, seqs, field, min_similarity):
+        index = SimilarityIndex(seqs, field, min_similarity)
+        assignments = []
+        for i, seq in enumerate(seqs):
+            if seq.clone_id is not None:
+                continue
+            clone_id = index.find_clone(i)
+            if clone_id is None:
+                clone_id = len(index.clone_ids) + 100
+            index.assign(i, clone_id)
+            assignments.append(clone_id)
+        return assignments
+
+    def test_matches_similar_to_all(self):
+        rand = random.Random(1)
+        root = ''.join(rand.choice('ACGT') for _ in range(36))
+        for trial in range(20):
+            seqs = []
+            for _ in range(60):
+                cdr3 = list(root)
+                for _ in range(rand.randint(0, 6)):
+                    cdr3[rand.randrange(len(cdr3))] = rand.choice('ACGTN-')
+                seqs.append(MockSequence(''.join(cdr3), rand.choice(
+                    [None] * 4 + [1, 2])))
+            for field in ('nt', 'aa'):
+                for min_similarity in (.85, .7):
+                    assert self.assign(seqs, field, min_similarity) == (
+                        self.assign_indexed(seqs, field, min_similarity))
+
+    def test_subclones(self):
+        rand = random.Random(2)
+        root = ''.join(rand.choice('ACGT') for _ in range(36))
+        clones = {}
+        for clone_id in range(1, 9):
+            for _ in range(rand.randint(1, 5)):
+                cdr3 = list(root)
+                for _ in range(rand.randint(0, 6)):
+                    cdr3[rand.randrange(len(cdr3))] = rand.choice('ACGTN')
+                clones.setdefault(clone_id, []).append(
+                    MockSequence(''.join(cdr3), clone_id))
+        parents = [s for clone_id in range(1, 5) for s in clones[clone_id]]
+        index = SimilarityIndex(parents, 'aa', .8)
+        for sub_id in range(5, 9):
+            ruled_out = np.zeros(len(index.clone_ids), dtype=bool)
+            for seq in clones[sub_id]:
+                ruled_out |= index.dissimilar_clones(seq.cdr3_aa)
+            assert [not r for r in ruled_out] == [
+                can_subclone(clones[sub_id], clones[parent_id], .8)
+                for parent_id in index.clone_ids]
+
+
+class MockSession(object):
+    def __init__(self, next_clone_id):
+        self.next_clone_id = next_clone_id
+        self.updates = {}
+
+    def add(self, clone):
+        clone.id = self.next_clone_id
+        self.next_clone_id += 1
+
+    def flush(self):
+        pass
+
+    def bulk_update_mappings(self, model, mappings):
+        for mapping in mappings:
+            self.updates[mapping['ai']] = mapping['clone_id']
+
+
+class IncrementalTest(unittest.TestCase):
+    @mock.patch('immunedb.aggregation.clones.generate_consensus')
+    @mock.patch('immunedb.aggregation.clones.invalidate_clones')
+    def test_new_sequences(self, invalidate, consensus):
+        # Sequences with a clone were assigned by an earlier run, the rest
+        # were added with a new sample
+        cdr3s = [
+            ('TGTGCGAGAGATCGGGGCTACTGG', 1),
+            ('TGTGCGAGAGATCGGGGCTTCTGG', None),
+            ('TGTAAAAAAAATCGGGGCTACTGG', 2),
+            ('TGTGCGAGAGATCGGGGCTACTGG', None),
+            ('TGTCCCCCCCCCCCCCCCCACTGG', None),
+            ('TGTCCCCCCCCCCCCCCCCTCTGG', None),
+        ]
+        seqs = [
+            BucketSequence(1, ai, clone_id, cdr3_nt,
+                           lookups.aas_from_nts(cdr3_nt))
+            for ai, (cdr3_nt, clone_id) in enumerate(cdr3s)
+        ]
+        session = MockSession(next_clone_id=3)
+        worker = SimilarityClonalWorker(session, level='aa',
+                                        min_similarity=.85)
+        worker.run_bucket(PrefetchedBucket(
+            (1, 'IGHV1-2*02', 'IGHJ4*02', 24, None, None), seqs))
+
+        assert session.updates == {1: 1, 3: 1, 4: 3, 5: 3}
+        # Only the existing clone which gained sequences is invalidated
+        invalidate.assert_called_once_with(session, {1})
+        consensus.assert_called_once_with(session, {1, 3})
+
+
+class ExistingClonesTest(unittest.TestCase):
+    def setUp(self):
+        self.session = get_session()
+        study = Study(name='study')
+        self.session.add_all([
+            Subject(id=1, identifier='subject', study=study),
+            Sample(id=1, name='sample', study=study, subject_id=1),
+            Clone(id=1, subject_id=1),
+            Clone(id=2, subject_id=1),
+            Clone(id=3, subject_id=1, parent_id=2),
+        ])
+        self.ai = 0
+
+    def add_seq(self, v_gene, clone_id, copy_number_in_subject=2):
+        self.ai += 1
+        seq = Sequence(sample_id=1, ai=self.ai, subject_id=1,
+                       seq_id=str(self.ai), v_gene=v_gene, j_gene='IGHJ4',
+                       cdr3_num_nts=30, clone_id=clone_id,
+                       probable_indel_or_misalign=False)
+        self.session.add_all([seq, SequenceCollapse(
+            sample_id=1, seq_ai=self.ai,
+            copy_number_in_subject=copy_number_in_subject)])
+
+    def test_mixed_buckets(self):
+        # Both an assigned and an unassigned representative
+        self.add_seq('IGHV1-2', 1)
+        self.add_seq('IGHV1-2', None)
+        # Only the sequences collapsed to another are unassigned
+        self.add_seq('IGHV1-3', 1)
+        self.add_seq('IGHV1-3', None, copy_number_in_subject=0)
+        # Only unassigned sequences
+        self.add_seq('IGHV1-4', None)
+        self.session.commit()
+
+        worker = LineageClonalWorker(self.session)
+        assert [b.v_gene for b in worker.get_mixed_buckets(1)] == ['IGHV1-2']
+        args = argparse.Namespace(
+            method='lineage', subject_ids=[1], regen=False, gene=None)
+        with self.assertRaises(ValueError):
+            run_clones(self.session, args)
+
+    def test_delete_empty(self):
+        self.add_seq('IGHV1-2', 1)
+        self.add_seq('IGHV1-2', 3)
+        self.session.commit()
+
+        assert delete_empty_clones(self.session, [1, 2, 3]) == {2}
+        self.session.commit()
+        assert [(c.id, c.parent_id) for c in self.session.query(Clone)] == [
+            (1, None), (3, None)]
+
+    def test_push_skips_gaps(self):
+        for ai in (1, 2, 5000, 5001, 9999):
+            self.ai = ai - 1
+            self.add_seq('IGHV1-2', None)
+        self.session.commit()
+
+        # The updates are MySQL specific so only the ai ranges are recorded
+        starts = set()
+        connection = self.session.connection
+
+        class RecordingConnection(object):
+            def __init__(self, conn):
+                self.conn = conn
+
+            def execute(self, statement, *args, **kwargs):
+                if isinstance(statement, TextClause):
+                    starts.add(kwargs['start'])
+                    return []
+                return self.conn.execute(statement, *args, **kwargs)
+
+            def __getattr__(self, attr):
+                return getattr(self.conn, attr)
+
+        with mock.patch.object(
+                self.session, 'connection',
+                side_effect=lambda *args, **kwargs: RecordingConnection(
+                    connection(*args, **kwargs))):
+            push_clone_ids(self.session, [1], chunk_size=1000)
+        assert sorted(starts) == [1, 5000, 9999]
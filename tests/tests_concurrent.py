@@ -0,0 +1,104 @@
+import collections
+import json
+import multiprocessing as mp
+import os
+import tempfile
+import unittest
+
+import immunedb.util.concurrent as concurrent
+
+
+class RecordingWorker(concurrent.Worker):
+    def __init__(self, results):
+        self.results = results
+
+    def do_task(self, args):
+        if args == 'fail':
+            raise Exception('Failed task')
+        self.results.put(args)
+
+
+class TaskQueueTest(unittest.TestCase):
+    def test_largest_first(self):
+        tasks = concurrent.TaskQueue()
+        for name, cost in (('a', 3), ('b', 50), ('c', 4), ('d', 20)):
+            tasks.add_task(name, cost=cost)
+        tasks.add_task('e')
+        assert tasks.num_tasks() == 5
+        assert [args for _, args in tasks._ordered_tasks()] == [
+            'e', 'b', 'd', 'c', 'a']
+
+    def test_chunk_size(self):
+        tasks = concurrent.TaskQueue()
+        tasks._workers = [None, None]
+        pending = collections.deque([(50, 'a'), (5, 'b'), (3, 'c'), (3, 'd'),
+                                     (1, 'e')])
+        # Until the latency is known tasks are sent one at a time
+        assert tasks._next_chunk(pending, 62) == (['a'], 50)
+
+        tasks._record_latency(50, 5)
+        assert tasks._next_chunk(pending, 12) == (['b'], 5)
+        # Chunks take at most an even share of the remaining cost
+        assert tasks._next_chunk(pending, 7) == (['c'], 3)
+        assert tasks._next_chunk(pending, 4) == (['d'], 3)
+
+        # Faster tasks lower the estimated latency and increase chunk sizes
+        tasks._record_latency(3, .03)
+        assert abs(tasks._secs_per_cost - .082) < 1e-9
+        pending.extend((1, i) for i in range(2000))
+        assert len(tasks._next_chunk(pending, 5000)[0]) == 12
+
+        tasks._secs_per_cost = 1e-6
+        chunk, cost = tasks._next_chunk(pending, 5000)
+        assert len(chunk) == concurrent.MAX_CHUNK_SIZE
+
+    def test_zero_cost(self):
+        tasks = concurrent.TaskQueue()
+        tasks._workers = [None, None]
+        for i in range(100):
+            tasks.add_task(i, cost=0)
+        pending = tasks._ordered_tasks()
+        remaining = sum(cost for cost, _ in pending)
+        assert remaining == 100
+
+        chunk, cost = tasks._next_chunk(pending, remaining)
+        assert chunk == [0]
+        # The latency is measured per task so later chunks still grow
+        tasks._record_latency(cost, .1)
+        assert len(tasks._next_chunk(pending, remaining - cost)[0]) == 10
+
+    def test_progress(self):
+        progress = concurrent.TaskProgress(10, 100, 2)
+        status = progress.get_status()
+        assert status['eta_seconds'] is None
+        assert status['task_seconds'] is None
+
+        progress.started -= 10
+        progress.record(25, [1, 2, 3, 4])
+        status = progress.get_status(
+            [(1, 'a', 5), (2, 'b', 20)])
+        assert status['completed_tasks'] == 4
+        assert status['percent_complete'] == 40
+        assert 29 < status['eta_seconds'] < 31
+        assert status['task_seconds']['p50'] == 2.5
+        assert status['task_seconds']['max'] == 4
+        assert [r['task'] for r in status['slowest_running']] == ['b', 'a']
+
+    def test_run(self):
+        results = mp.Queue()
+        status_file = os.path.join(tempfile.mkdtemp(), 'status.json')
+        tasks = concurrent.TaskQueue(status_file=status_file)
+        for i in range(500):
+            tasks.add_task(i, cost=i % 7)
+        tasks.add_task('fail', cost=1)
+        tasks.add_workers(3, RecordingWorker, results)
+        tasks.start()
+
+        assert sorted(results.get() for _ in range(500)) == list(range(500))
+        assert results.empty()
+
+        with open(status_file) as fh:
+            status = json.load(fh)
+        assert status['complete']
+        assert status['completed_tasks'] == 501
+        assert status['eta_seconds'] == 0
@@ -0,0 +1,100 @@
+import argparse
+import os
+import random
+import unittest
+from unittest import mock
+
+import dnautils
+
+from immunedb.common.models import NoResult, Sample, Sequence
+from immunedb.identification.vdj_sequence import VDJAlignment, VDJSequence
+from immunedb.importing.delimited import run_import, UniqueAlignments
+
+from .database import get_session, numbered_sequences
+
+
+def make_alignment(seq_id, sequence):
+    seq = VDJSequence(seq_id, sequence)
+    seq.copy_number = 1
+    return VDJAlignment(seq)
+
+
+def brute_force(sequences):
+    uniques = []
+    for seq in sequences:
+        for other in uniques:
+            if len(other[0]) == len(seq) and dnautils.equal(other[0], seq):
+                other[1] += 1
+                break
+        else:
+            uniques.append([seq, 1])
+    return sorted(((s, c) for s, c in uniques), key=lambda u: len(u[0]))
+
+
+def random_sequences(rng, count, length=90):
+    # Shared IMGT-like gap positions, N padding at the start, and some reads
+    # repeated with an N
+    seqs = []
+    for i in range(count):
+        if seqs and rng.random() < .3:
+            seq = list(rng.choice(seqs))
+            seq[rng.randrange(length)] = 'N'
+        else:
+            seq = [rng.choice('ACGT') for _ in range(length)]
+            seq[30:33] = '---'
+            seq[:rng.randrange(6)] = 'N' * 5
+        seqs.append(''.join(seq)[:length])
+    return seqs
+
+
+class UniqueAlignmentsTest(unittest.TestCase):
+    def test_matches_pairwise(self):
+        rng = random.Random(1)
+        for _ in range(5):
+            seqs = random_sequences(rng, 300)
+            uniques = UniqueAlignments()
+            for i, seq in enumerate(seqs):
+                uniques.add(make_alignment('seq{}'.format(i), seq))
+            assert [
+                (u.sequence.sequence, u.sequence.copy_number)
+                for u in uniques
+            ] == [(s, c) for s, c in brute_force(seqs)]
+
+    def test_comparisons(self):
+        rng = random.Random(2)
+        seqs = random_sequences(rng, 2000)
+        uniques = UniqueAlignments()
+        with mock.patch('dnautils.equal', wraps=dnautils.equal) as equal:
+            for i, seq in enumerate(seqs):
+                uniques.add(make_alignment('seq{}'.format(i), seq))
+        # Comparing every pair would take over a million comparisons
+        assert equal.call_count < 2 * len(seqs)
+
+
+class ImportTest(unittest.TestCase):
+    def import_rows(self, nproc):
+        session = get_session()
+        args = argparse.Namespace(
+            v_germlines='tests/data/germlines/imgt_human_v.fasta',
+            j_germlines='tests/data/germlines/imgt_human_j.fasta',
+            upstream_of_cdr3=31, anchor_len=18, metadata=None,
+            sample_dir='tests/data/identification_import',
+            warn_existing=False, warn_missing=False, format='changeo',
+            max_padding=None, trim_to=None, nproc=nproc)
+        with mock.patch.dict(os.environ, {'IMMUNEDB_GERMLINE_CACHE': ''}):
+            with numbered_sequences():
+                run_import(session, args)
+
+        def rows(model, exclude):
+            columns = [c for c in model.__table__.c if c.name != exclude]
+            return sorted(
+                tuple(row) for row in session.query(*columns)
+            )
+        return (rows(Sample, None), rows(Sequence, 'ai'),
+                rows(NoResult, 'pk'))
+
+    def test_parallel_matches_serial(self):
+        samples, sequences, noresults = self.import_rows(1)
+        assert len(samples) == 2
+        assert len(sequences) > 0
+        assert self.import_rows(2) == (samples, sequences, noresults)
@@ -0,0 +1,48 @@
+from collections import namedtuple
+import unittest
+
+from immunedb.identification.local_align import find_duplicates
+
+MockSequence = namedtuple('MockSequence', (
+    'ai', 'seq_id', 'v_gene', 'j_gene', 'cdr3_num_nts', 'sequence',
+    'copy_number', 'locally_aligned'))
+
+
+def seq(ai, sequence, copy_number=1, locally_aligned=False, v_gene='V1'):
+    return MockSequence(ai, 'seq{}'.format(ai), v_gene, 'J1', 12, sequence,
+                        copy_number, locally_aligned)
+
+
+class FindDuplicatesTest(unittest.TestCase):
+    def test_exact(self):
+        updated, removed = find_duplicates([
+            seq(1, 'AC--GTAC', 2),
+            seq(2, 'AC--GTAC', 3, locally_aligned=True),
+            seq(3, 'AC--GTAA', 1, locally_aligned=True),
+            # Different genes are never duplicates
+            seq(4, 'AC--GTAA', 5, v_gene='V2'),
+        ])
+        assert updated == {1: 5}
+        assert removed == [2]
+
+    def test_wildcards(self):
+        updated, removed = find_duplicates([
+            seq(1, 'ACGTGTAC', 2),
+            seq(2, 'ACNTGTAC', 1, locally_aligned=True),
+            seq(3, 'AC-TGTAC', 4, locally_aligned=True),
+            seq(4, 'TTNTGTAC', 1, locally_aligned=True),
+        ])
+        # The N sequence merges into the highest copy match, which is then
+        # merged itself since it is locally aligned and matches the first
+        assert removed == [2, 3]
+        assert updated == {1: 7}
+
+    def test_copy_numbers(self):
+        updated, removed = find_duplicates([
+            seq(1, 'ACGTACGT', 2),
+            seq(2, 'ACGTACGT', 6),
+            seq(3, 'ACGTACGT', 3, locally_aligned=True),
+            seq(4, 'ACGTACGT', 1, locally_aligned=True),
+        ])
+        assert removed == [3, 4]
+        assert updated == {2: 10}
@@ -0,0 +1,41 @@
+from collections import OrderedDict
+import unittest
+
+import ete3
+import numpy as np
+
+from immunedb.trees.nj import distance_matrix, get_tree, neighbor_join
+
+
+class NeighborJoinTest(unittest.TestCase):
+    def test_distances(self):
+        dists = distance_matrix(['ACGT', 'ACGA', 'NCG-', 'TTTT'])
+        assert dists.tolist() == [
+            [0, 1, 0, 3],
+            [1, 0, 0, 4],
+            [0, 0, 0, 2],
+            [3, 4, 2, 0],
+        ]
+
+    def test_join(self):
+        dists = np.array([
+            [0, 5, 9, 9, 8],
+            [5, 0, 10, 10, 9],
+            [9, 10, 0, 8, 7],
+            [9, 10, 8, 0, 3],
+            [8, 9, 7, 3, 0],
+        ])
+        tree = neighbor_join(['a', 'b', 'c', 'd', 'e'], dists)
+        expected = ete3.Tree('((a,b),c,(d,e));')
+        assert tree.robinson_foulds(expected, unrooted_trees=True)[0] == 0
+        assert (tree & 'a').dist == 2
+        assert (tree & 'b').dist == 3
+        assert (tree & 'd').dist == 2
+        assert (tree & 'e').dist == 1
+
+    def test_tiny(self):
+        tree = get_tree(OrderedDict([('germline', 'ACGT'), ('1', 'ACGA')]))
+        assert sorted(tree.get_leaf_names()) == ['1', 'germline']
+        tree.set_outgroup('germline')
+        tree.search_nodes(name='germline')[0].delete()
+        assert tree.get_leaf_names() == ['1']
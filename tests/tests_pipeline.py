@@ -26,5 +26,10 @@ class TestPipeline(BaseTest.RegressionTest):
                 trim_to=None,
                 max_padding=None,
                 genotyping=False,
+                shard_index=None,
+                num_shards=None,
+                shard_dir=None,
+                merge_shards=False,
+                resume_dir=None,
             )
         )
@@ -0,0 +1,74 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import immunedb.identification.identify as identify
+from immunedb.identification.genes import JGermlines, VGermlines
+from immunedb.identification.shards import find_shards, merge_shards
+from immunedb.identification.vdj_sequence import VDJSequence
+import immunedb.util.concurrent as concurrent
+
+
+class UnbuildableSequence(VDJSequence):
+    def __init__(self, seq_id, *args, **kwargs):
+        if seq_id.startswith('unbuildable_'):
+            raise ValueError('Unbuildable sequence')
+        super(UnbuildableSequence, self).__init__(seq_id, *args, **kwargs)
+
+
+class ShardTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with mock.patch.dict(os.environ, {'IMMUNEDB_GERMLINE_CACHE': ''}):
+            cls.v_germlines = VGermlines(
+                'tests/data/germlines/imgt_human_v.fasta')
+            cls.j_germlines = JGermlines(
+                'tests/data/germlines/imgt_human_j.fasta', 31, 18, 12)
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'input.fastq')
+        with open('tests/data/identification/input.fastq') as fh:
+            lines = fh.readlines()[:4 * 150]
+        records = [lines[i:i + 4] for i in range(0, len(lines), 4)]
+        # A read which passes validation but cannot be built, so it is
+        # counted when sharding but never aligned
+        records.insert(3, [records[3][0].replace('@', '@unbuildable_')] +
+                       records[3][1:])
+        # Identical reads in different shards are collapsed when merged
+        records.extend(records[10:20])
+        with open(self.path, 'w') as fh:
+            for record in records:
+                fh.writelines(record)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def summarize(self, alignments):
+        return (
+            [(a.sequence.seq_id, a.sequence.copy_number, a.v_gene, a.j_gene)
+             for a in alignments['success']],
+            [(r['vdj'].seq_id, r['reason']) for r in alignments['noresult']]
+        )
+
+    @mock.patch.object(identify, 'VDJSequence', UnbuildableSequence)
+    def test_matches_unsharded(self):
+        aligner = identify.AnchorAligner(self.v_germlines, self.j_germlines)
+        unsharded = self.summarize(concurrent.process_data(
+            identify.read_input, identify.process_vdj,
+            identify.aggregate_vdj, 2, generate_args={'path': self.path},
+            process_args={'aligner': aligner}))
+        assert len(unsharded[0]) > 0
+
+        for num_shards in (2, 3):
+            shard_dir = os.path.join(self.dir, str(num_shards))
+            os.mkdir(shard_dir)
+            for shard_index in range(num_shards):
+                identify.process_shard(
+                    self.v_germlines, self.j_germlines, self.path,
+                    {'sample_name': 'sample'}, 2, shard_index, num_shards,
+                    shard_dir)
+            merged = merge_shards(find_shards(shard_dir, 'sample'), 'sample')
+            assert self.summarize(merged) == unsharded
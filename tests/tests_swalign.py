@@ -0,0 +1,39 @@
+import unittest
+
+from immunedb.identification.swalign import compress_cigar, LocalAligner
+
+
+class SWAlignTest(unittest.TestCase):
+    def setUp(self):
+        self.references = {
+            'IGHV1': 'GACTTACGGATCCAGTTTGCAAGCTAGCAGGTCCATAGCTAGGTAC',
+            'IGHV2': 'TTGCAGCTACAGATCGATTACGCGCATTAGCAGCTATCGACGTAAC',
+        }
+        self.aligner = LocalAligner(self.references, kmer_len=8)
+
+    def test_cigar(self):
+        assert compress_cigar('SSMMMDMMI') == '2S3M1D2M1I'
+
+    def test_exact(self):
+        read = 'AAAA' + self.references['IGHV1'][5:40] + 'CCCC'
+        result = self.aligner.align('seq', read)
+        assert result['reference'] == 'IGHV1'
+        assert result['ref_offset'] == '6'
+        assert result['cigar'] == '4S35M4S'
+        assert result['flags'] == '0'
+
+    def test_reverse_complement(self):
+        read = 'GTTACGTCGATAGCTGCTAATGCGCGTAATCGATCTGTAGCTGCAA'
+        result = self.aligner.align('seq', read)
+        assert result['reference'] == 'IGHV2'
+        assert result['flags'] == '16'
+        assert result['read_seq'] == self.references['IGHV2']
+
+    def test_deletion(self):
+        ref = self.references['IGHV2']
+        read = ref[:20] + ref[23:]
+        result = self.aligner.align('seq', read)
+        assert result['cigar'] == '20M3D23M'
+
+    def test_unaligned(self):
+        assert self.aligner.align('seq', 'ACGT' * 4) is None